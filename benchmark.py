@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+# MIT License
+# Copyright (c) 2018 Matt Westfall (@disloops)
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import psadify
+
+ALERT_BLOCK = """=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+         Danger level: [{danger}] (out of 5)
+
+    Scanned TCP ports: [{port_lo}-{port_hi}: {packets} packets, Nmap: -sT or -sS]
+            TCP flags: [SYN: {packets}]
+       iptables chain: INPUT (prefix "DROP"), {packets} packets
+
+               Source: {ip}
+                  DNS: [No reverse dns info available]
+             OS_guess: Linux:2.6::Linux 2.6
+
+          Destination: 192.168.1.10
+                  DNS: [No reverse dns info available]
+
+   Overall scan start: {start}
+   Total email alerts: {alerts}
+   Complete TCP range: [{port_lo}-{port_hi}]
+      Syslog hostname: pi
+
+         Global stats: chain:   interface:   TCP:   UDP:   ICMP:
+                       INPUT    eth0         {packets}     0      0
+
+[+] TCP scan signatures:
+
+   "ET SCAN Potential SSH Scan"
+       dst port:  22 (no server bound to local port)
+       flags:     SYN
+       sid:       2001219
+       chain:     INPUT
+       packets:   {packets}
+       classtype: attempted-recon
+
+"""
+
+# the WHOIS layouts psad stores, plus IPs with no usable country
+WHOIS_VARIANTS = {
+    'ripe': 'inetnum:        {ip} - {ip}\nnetname:        NET-{n}\ncountry:        {country}\norg-name:       Example Hosting {n} Ltd\n',
+    'arin': 'NetRange:       {ip} - {ip}\nNetName:        NET-{n}\nOrganization:   Example Networks {n}, Inc. (EN-{n})\nCountry:        {country}\n',
+    'apnic': 'inetnum:        {ip} - {ip}\nnetname:        APNIC-NET-{n}\ncountry:        {country}\nowner:          Example Telecom {n}\n',
+    'bare': '% No entries found for the selected source(s).\n'
+}
+
+COUNTRIES = ('US', 'CN', 'RU', 'DE', 'NL', 'BR', 'IN', 'KR', 'VN', 'FR')
+
+# create a synthetic psad log tree and config file under root
+def make_tree(root, ips=1000, alert_size=4096, whois_variants=tuple(WHOIS_VARIANTS), whois_missing=0.1,
+              attackers=None, sigs=200, ports=2000, seed=1):
+
+    rng = random.Random(seed)
+    log_dir = os.path.join(root, 'psad')
+    os.makedirs(log_dir)
+
+    now = time.time()
+    addresses = set()
+    while len(addresses) < ips:
+        addresses.add('%d.%d.%d.%d' % (rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254)))
+    addresses = sorted(addresses)
+
+    for n, ip in enumerate(addresses):
+        ip_dir = os.path.join(log_dir, ip)
+        os.mkdir(ip_dir)
+
+        port_lo = rng.randint(1, 60000)
+        block = ALERT_BLOCK.format(danger=rng.randint(1, 5), port_lo=port_lo, port_hi=port_lo + rng.randint(0, 5000),
+                                   packets=rng.randint(1, 500), ip=ip, alerts=rng.randint(1, 50),
+                                   start=time.ctime(now - rng.randint(0, 86400 * 30)))
+        alert_file = os.path.join(ip_dir, ip + '_email_alert')
+        with open(alert_file, 'w') as f:
+            f.write(block * max(1, alert_size // len(block)))
+        mtime = now - rng.randint(0, 86400 * 30)
+        os.utime(alert_file, (mtime, mtime))
+
+        if rng.random() >= whois_missing:
+            variant = WHOIS_VARIANTS[rng.choice(whois_variants)]
+            with open(os.path.join(ip_dir, ip + '_whois'), 'w') as f:
+                f.write(variant.format(ip=ip, n=n, country=rng.choice(COUNTRIES)))
+
+    # psad lists attackers whose directories have since been cleaned up,
+    # so a top_attackers file can be far longer than the tree
+    listed = addresses[:attackers]
+    if attackers is not None and attackers > ips:
+        listed += ['%d.%d.%d.%d' % (rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254)) for i in range(attackers - ips)]
+
+    with open(os.path.join(log_dir, 'top_attackers'), 'w') as f:
+        f.write('# Top attackers (sorted by number of packets):\n')
+        for ip in listed:
+            f.write('%s  [%d]  %d  %d  %s\n' % (ip, rng.randint(1, 5), rng.randint(1, 100000), rng.randint(0, 20), time.ctime(now)))
+
+    with open(os.path.join(log_dir, 'top_sigs'), 'w') as f:
+        f.write('# Top signature matches:\n')
+        for sid in range(sigs):
+            f.write('%d  "ET SCAN Synthetic Signature %d"  %d  %d\n' % (2000000 + sid, sid, rng.randint(1, 100000), rng.randint(1, 500)))
+
+    with open(os.path.join(log_dir, 'top_ports'), 'w') as f:
+        f.write('# Top scanned ports:\n')
+        for port in range(ports):
+            f.write('%s %d %d\n' % (rng.choice(('tcp', 'udp')), rng.randint(1, 65535), rng.randint(1, 100000)))
+
+    # psad rewrote these a while ago, not just as the timing starts
+    for name in ('top_attackers', 'top_sigs', 'top_ports'):
+        os.utime(os.path.join(log_dir, name), (now - 60, now - 60))
+
+    conf_file = os.path.join(root, 'psad.conf')
+    with open(conf_file, 'w') as f:
+        f.write('HOSTNAME pi;\n')
+
+    return log_dir, conf_file
+
+# forget everything psadify keeps in-process between runs
+def reset_caches():
+
+    psadify._catalogs.clear()
+    psadify._whois_caches.clear()
+    psadify._snapshots.clear()
+
+# time one call, returning (seconds, result)
+def timed(func, *args):
+
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+# peak bytes allocated during one call, returning (bytes, result)
+def traced(func, *args):
+
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        return tracemalloc.get_traced_memory()[1], result
+    finally:
+        tracemalloc.stop()
+
+# time (or with measure=traced, trace the memory of) each collector and
+# the HTML stage against a log tree
+def run_stages(log_dir, conf_file, output_file, attackers, measure=timed):
+
+    timings = {}
+    data = {}
+    for name, input in psadify.COLLECTORS:
+        timings[name], data[name] = measure(psadify.run_collector, name, attackers, log_dir)
+
+    chunks = psadify.iter_html(data['last_attacks'], data['top_attackers'], data['top_signatures'], data['top_ports'], attackers, conf_file)
+    timings['html'], changed = measure(psadify.write_atomic, output_file, chunks)
+
+    return timings
+
+# load the stored results, one entry per benchmark run
+def load_results(results_file):
+
+    try:
+        with open(results_file, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+
+# print timings next to the last stored run with the same parameters
+def print_comparison(run, previous):
+
+    print(' %-20s %10s %10s %10s' % ('stage', 'seconds', 'previous', 'change'))
+    for phase in ('cold', 'warm', 'peak_kib'):
+        for stage in sorted(run.get(phase, {})):
+            seconds = run[phase][stage]
+            line = ' %-20s %10.4f' % (phase + ':' + stage, seconds)
+            if previous and stage in previous.get(phase, {}):
+                before = previous[phase][stage]
+                change = (seconds - before) / before * 100 if before else 0.0
+                line += ' %10.4f %+9.1f%%' % (before, change)
+            print(line)
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark PSADify against a synthetic PSAD log tree.')
+    parser.add_argument('--ips', help='Number of IP directories (default: 1000)', type=int, default=1000)
+    parser.add_argument('--alert-size', help='Approximate bytes per _email_alert file (default: 4096)', type=int, default=4096)
+    parser.add_argument('--whois', help='Comma separated WHOIS variants: ' + ','.join(sorted(WHOIS_VARIANTS)) + ' (default: all)', type=str, default=','.join(sorted(WHOIS_VARIANTS)))
+    parser.add_argument('--whois-missing', help='Fraction of IPs without a WHOIS file (default: 0.1)', type=float, default=0.1)
+    parser.add_argument('--top-attackers', help='Lines in top_attackers (default: one per IP)', type=int)
+    parser.add_argument('--top-sigs', help='Lines in top_sigs (default: 200)', type=int, default=200)
+    parser.add_argument('--top-ports', help='Lines in top_ports (default: 2000)', type=int, default=2000)
+    parser.add_argument('-n', '--attackers', help='Top attackers to look up (default: ' + str(psadify.TOP_ATTACKERS) + ')', type=int, default=psadify.TOP_ATTACKERS)
+    parser.add_argument('-j', '--jobs', help='Threads for collection (default: 1)', type=int, default=1)
+    parser.add_argument('--seed', help='Random seed for the tree (default: 1)', type=int, default=1)
+    parser.add_argument('--results', help='JSON file the results are appended to (default: benchmark_results.json)', type=str, default='benchmark_results.json')
+    parser.add_argument('--memory', help='Also trace the peak memory of each stage on a warm run (slow)', action='store_true')
+    parser.add_argument('--keep', help='Keep the generated tree and print its location', action='store_true')
+    args = parser.parse_args()
+
+    params = {
+        'ips': args.ips,
+        'alert_size': args.alert_size,
+        'whois': args.whois,
+        'whois_missing': args.whois_missing,
+        'top_attackers': args.top_attackers,
+        'top_sigs': args.top_sigs,
+        'top_ports': args.top_ports,
+        'attackers': args.attackers,
+        'jobs': args.jobs,
+        'seed': args.seed
+    }
+
+    root = tempfile.mkdtemp(prefix='psadify-bench-')
+    try:
+        print(' [*] Generating ' + str(args.ips) + ' IP directories in ' + root)
+        log_dir, conf_file = make_tree(root, args.ips, args.alert_size, args.whois.split(','), args.whois_missing,
+                                       args.top_attackers, args.top_sigs, args.top_ports, args.seed)
+
+        psadify.CACHE_DIR = os.path.join(root, 'cache')
+        psadify.set_jobs(args.jobs)
+        output_file = os.path.join(root, 'status.html')
+
+        # cold is a first run with nothing cached, warm a repeat run
+        reset_caches()
+        cold = run_stages(log_dir, conf_file, output_file, args.attackers)
+        reset_caches()
+        warm = run_stages(log_dir, conf_file, output_file, args.attackers)
+
+        peak = None
+        if args.memory and tracemalloc is not None:
+            reset_caches()
+            peak = run_stages(log_dir, conf_file, output_file, args.attackers, traced)
+            peak = dict((stage, size / 1024.0) for stage, size in peak.items())
+    finally:
+        if args.keep:
+            print(' [*] Kept the tree in ' + root)
+        else:
+            shutil.rmtree(root)
+
+    run = {
+        'version': psadify.__version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'params': params,
+        'cold': cold,
+        'warm': warm
+    }
+    if peak is not None:
+        run['peak_kib'] = peak
+
+    results = load_results(args.results)
+    previous = None
+    for result in results:
+        if result.get('params') == params:
+            previous = result
+
+    print_comparison(run, previous)
+
+    results.append(run)
+    with open(args.results, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(' [*] Results appended to ' + args.results)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -29,319 +29,1677 @@ import os
 import re
 import sys
 import time
-import glob
-import urllib
+import errno
+import struct
+import io
+import gzip
+import json
+import heapq
+import bisect
+import binascii
+import array
+import csv
+import itertools
+import hashlib
+import tempfile
 import socket
 import argparse
+import threading
+import contextlib
+import collections
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+try:
+    from urllib import quote_plus
+except ImportError:
+    from urllib.parse import quote_plus
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# inotify comes from the C library on Linux; elsewhere watch mode polls
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init1
+except (ImportError, OSError, AttributeError):
+    libc = None
+
+PSAD_LOG_DIR = '/var/log/psad'
+PSAD_CONF_FILE = '/etc/psad/psad.conf'
+CACHE_DIR = '/var/cache/psadify'
+TOP_ATTACKERS = 50
+SNAPSHOT_RETRIES = 8
+ALERT_READ_LIMIT = 256 * 1024
+
+# catalog entries are stored as compact lists to keep the state file small
+CATALOG_VERSION = 4
+DIR_MTIME, ALERT_NAME, ALERT_MTIME, ALERT_FIELDS, ALERT_PORTS = range(5)
+
+# in-process copies of the state files so repeated runs skip the JSON load
+_catalogs = {}
+
+# counters kept per stage while --metrics is on
+METRIC_COUNTERS = ('files_stated', 'files_opened', 'dirs_listed', 'bytes_read', 'records', 'dropped')
+_metrics = None
+_metrics_lock = threading.Lock()
+_stage = threading.local()
+
+# start collecting metrics for a new run
+def start_metrics():
+
+    global _metrics
+    _metrics = {}
+
+# CPU time of the calling thread, or of the process on older Pythons
+def get_cpu_time():
+
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    return sum(os.times()[:2])
+
+# the stage the calling thread is working for
+def get_stage():
+
+    return getattr(_stage, 'name', None)
+
+# add to one of the current stage's counters
+def count(counter, amount=1):
+
+    if _metrics is None:
+        return
+
+    with _metrics_lock:
+        stage_metrics = _metrics.setdefault(get_stage() or 'other', dict.fromkeys(METRIC_COUNTERS + ('wall_seconds', 'cpu_seconds'), 0))
+        stage_metrics[counter] += amount
+
+# attribute the work done inside the block to a stage; worker threads pass
+# wall=False so only the stage's own thread adds wall time
+@contextlib.contextmanager
+def stage(name, wall=True):
+
+    if _metrics is None:
+        yield
+        return
+
+    previous = get_stage()
+    _stage.name = name
+    start_wall = time.time()
+    start_cpu = get_cpu_time()
+    try:
+        yield
+    finally:
+        count('cpu_seconds', get_cpu_time() - start_cpu)
+        if wall:
+            count('wall_seconds', time.time() - start_wall)
+        _stage.name = previous
+
+# yield from an iterator, timing each step as part of a stage
+def iter_stage(name, chunks):
+
+    chunks = iter(chunks)
+    while True:
+        with stage(name):
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+        yield chunk
+
+# write the metrics of the last run as JSON and as a Prometheus
+# textfile-collector file
+def write_metrics(metrics_dir, duration):
+
+    stages = _metrics or {}
+    now = time.time()
+
+    if not os.path.isdir(metrics_dir):
+        os.makedirs(metrics_dir)
+
+    report = {
+        'version': __version__,
+        'timestamp': now,
+        'duration_seconds': duration,
+        'stages': stages
+    }
+    write_atomic(os.path.join(metrics_dir, 'psadify.json'), [json.dumps(report, sort_keys=True, indent=2)])
+
+    lines = [
+        '# HELP psadify_run_duration_seconds Wall time of the last run.',
+        '# TYPE psadify_run_duration_seconds gauge',
+        'psadify_run_duration_seconds %f' % duration,
+        '# HELP psadify_last_run_timestamp_seconds When the last run finished.',
+        '# TYPE psadify_last_run_timestamp_seconds gauge',
+        'psadify_last_run_timestamp_seconds %f' % now
+    ]
+    for counter in ('wall_seconds', 'cpu_seconds') + METRIC_COUNTERS:
+        metric = 'psadify_stage_' + counter
+        lines.append('# HELP ' + metric + ' ' + counter.replace('_', ' ').capitalize() + ' per stage in the last run.')
+        lines.append('# TYPE ' + metric + ' gauge')
+        for name in sorted(stages):
+            lines.append('%s{stage="%s"} %s' % (metric, name, repr(stages[name][counter])))
+    write_atomic(os.path.join(metrics_dir, 'psadify.prom'), ['\n'.join(lines) + '\n'])
+
+# worker threads for file I/O, set up by set_jobs()
+_io_pool = None
+_jobs = 1
+
+# size the worker pools used for collection
+def set_jobs(jobs):
+
+    global _io_pool, _jobs
+
+    _jobs = max(1, jobs)
+    _io_pool = ThreadPool(_jobs) if _jobs > 1 else None
+
+# map over items on the I/O pool, keeping the input order; the workers
+# count towards the caller's stage
+def parallel_map(func, items):
+
+    if _io_pool is None or len(items) < 2:
+        return [func(item) for item in items]
+
+    name = get_stage()
+
+    def run(item):
+        with stage(name, wall=False):
+            return func(item)
+
+    return _io_pool.map(run, items, max(1, len(items) // (_jobs * 4)))
+
+# name a state file after the log directory it describes
+def get_state_name(prefix, log_dir):
+
+    digest = hashlib.sha1(os.path.abspath(log_dir).encode('utf-8')).hexdigest()
+    return prefix + '-' + digest[:12] + '.json'
+
+# load a JSON state file from the cache directory
+def load_state(name):
+
+    if not CACHE_DIR:
+        return None
+
+    try:
+        with open(os.path.join(CACHE_DIR, name), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+# replace a JSON state file in the cache directory atomically
+def save_state(name, data):
+
+    if not CACHE_DIR:
+        return
+
+    tmp_file = None
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        fd, tmp_file = tempfile.mkstemp(prefix='.' + name, dir=CACHE_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.rename(tmp_file, os.path.join(CACHE_DIR, name))
+    except (IOError, OSError):
+        if tmp_file and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+# private and local ranges that are never reported
+DEFAULT_EXCLUDES = (
+    '10.0.0.0/8',
+    '127.0.0.0/8',
+    '172.16.0.0/12',
+    '192.168.0.0/16',
+    '::1/128',
+    'fc00::/7',
+    'fe80::/10'
+)
+
+ADDRESS_BITS = {socket.AF_INET: 32, socket.AF_INET6: 128}
+IPV4_MAPPED = 0xffff << 32
+
+# parse an IPv4 or IPv6 address into (family, integer), or None; IPv4
+# addresses mapped into IPv6 are treated as IPv4
+def parse_ip(text):
+
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            value = int(binascii.hexlify(socket.inet_pton(family, text)), 16)
+        except (socket.error, ValueError, TypeError):
+            continue
+        if family == socket.AF_INET6 and value >> 32 == 0xffff:
+            return socket.AF_INET, value ^ IPV4_MAPPED
+        return family, value
+    return None
+
+# parse ADDRESS[/PREFIX] into (family, first, last)
+def parse_network(spec):
+
+    address, slash, prefix = spec.strip().partition('/')
+    ip = parse_ip(address)
+    if ip is None:
+        raise ValueError('invalid network: ' + spec)
+
+    family, value = ip
+    bits = ADDRESS_BITS[family]
+    if ':' in address and family == socket.AF_INET and prefix:
+        prefix = str(int(prefix) - 96)
+    prefix = int(prefix) if prefix else bits
+    if not 0 <= prefix <= bits:
+        raise ValueError('invalid prefix length: ' + spec)
+
+    host_mask = (1 << (bits - prefix)) - 1
+    return family, value & ~host_mask, value | host_mask
+
+# turn network specs into sorted, merged integer ranges per family, so a
+# lookup is a bisect however many networks there are
+def build_network_set(specs):
+
+    ranges = dict((family, []) for family in ADDRESS_BITS)
+    for spec in specs:
+        family, first, last = parse_network(spec)
+        ranges[family].append((first, last))
+
+    network_set = {}
+    for family, family_ranges in ranges.items():
+        starts = []
+        ends = []
+        for first, last in sorted(family_ranges):
+            if ends and first <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], last)
+            else:
+                starts.append(first)
+                ends.append(last)
+        network_set[family] = (starts, ends)
+
+    return network_set
+
+# check a parsed (family, integer) address against a network set
+def in_network_set(network_set, ip):
+
+    starts, ends = network_set[ip[0]]
+    i = bisect.bisect_right(starts, ip[1]) - 1
+    return i >= 0 and ip[1] <= ends[i]
+
+# read network specs from a file, one per line with # comments
+def read_networks(file):
+
+    specs = []
+    with open(file, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                specs.append(line)
+    return specs
+
+# networks that are skipped, and networks reported even when excluded
+_excluded = build_network_set(DEFAULT_EXCLUDES)
+_allowed = build_network_set(())
+
+# set up the exclusion and allow lists from files of networks
+def set_ip_filter(exclude_files=(), allow_files=()):
+
+    global _excluded, _allowed
+
+    excludes = list(DEFAULT_EXCLUDES)
+    for file in exclude_files:
+        excludes.extend(read_networks(file))
+    allows = []
+    for file in allow_files:
+        allows.extend(read_networks(file))
+
+    _excluded = build_network_set(excludes)
+    _allowed = build_network_set(allows)
+
+# check that a string is an IP address psadify should report
+def is_reported_ip(text):
+
+    ip = parse_ip(text)
+    if ip is None:
+        return False
+    return in_network_set(_allowed, ip) or not in_network_set(_excluded, ip)
+
+# stat one IP's alert file, listing the directory only when its own mtime
+# says a file was added or removed; returns True if the entry changed
+def refresh_catalog_entry(log_dir, ip, entry):
+
+    path = os.path.join(log_dir, ip)
+    mtime = None
+    changed = False
+
+    if entry[ALERT_NAME]:
+        try:
+            count('files_stated')
+            mtime = os.stat(os.path.join(path, entry[ALERT_NAME])).st_mtime
+        except OSError:
+            entry[ALERT_NAME] = None
+            entry[DIR_MTIME] = None
+
+    if not entry[ALERT_NAME]:
+        try:
+            count('files_stated')
+            dir_mtime = os.stat(path).st_mtime
+            if dir_mtime != entry[DIR_MTIME]:
+                entry[DIR_MTIME] = dir_mtime
+                changed = True
+                count('dirs_listed')
+                for file in os.listdir(path):
+                    file_path = os.path.join(path, file)
+                    if file.endswith('_email_alert') and not os.path.isdir(file_path):
+                        count('files_stated', 2)
+                        file_mtime = os.path.getmtime(file_path)
+                        if mtime is None or file_mtime > mtime:
+                            entry[ALERT_NAME] = file
+                            mtime = file_mtime
+        except OSError:
+            pass
+
+    if mtime != entry[ALERT_MTIME]:
+        entry[ALERT_MTIME] = mtime
+        entry[ALERT_FIELDS] = None
+        changed = True
+
+    return changed
+
+# catalogs are refreshed one at a time, so collectors on other threads
+# wait for a refresh in progress rather than starting their own
+_catalog_lock = threading.RLock()
+
+# bring the catalog of IP directories and alert files up to date
+def refresh_catalog(log_dir=PSAD_LOG_DIR):
+
+    with _catalog_lock:
+        name = get_state_name('catalog', log_dir)
+        catalog = _catalogs.get(name) or load_state(name)
+        if not catalog or catalog.get('version') != CATALOG_VERSION:
+            catalog = {'version': CATALOG_VERSION, 'root_mtime': None, 'ips': {}, 'generation': 0}
+
+        ips = catalog['ips']
+        changed = False
+
+        # under inotify, a catalog that was brought up to date in full since
+        # the watch started only needs a look at the IPs that had events
+        watch = _alert_watches.get(log_dir)
+        touched = None
+        if watch is not None:
+            if watch['synced'] and _catalogs.get(name) is catalog:
+                touched = watch['ips']
+            watch['ips'] = set()
+
+        # the log root only changes when psad adds or expires an IP directory
+        count('files_stated')
+        root_mtime = os.stat(log_dir).st_mtime
+        if root_mtime != catalog['root_mtime']:
+            count('dirs_listed')
+            current = set(ip for ip in os.listdir(log_dir) if parse_ip(ip) is not None)
+            # new IPs go in before expired ones go, so a catalog that is
+            # already shared never misses an IP that is still there
+            for ip in current:
+                if ip not in ips:
+                    ips[ip] = [None] * 5
+                    if touched is not None:
+                        touched.add(ip)
+            for ip in list(ips):
+                if ip not in current:
+                    del ips[ip]
+            catalog['root_mtime'] = root_mtime
+            changed = True
+
+        # psad rewrites alert files in place without touching the directory
+        # mtime, so known alert files get a single stat each
+        if touched is None:
+            entries = list(ips.items())
+            if watch is not None:
+                watch['synced'] = True
+        else:
+            entries = [(ip, ips[ip]) for ip in touched if ip in ips]
+        results = parallel_map(lambda item: refresh_catalog_entry(log_dir, item[0], item[1]), entries)
+        changed = any(results) or changed
+
+        # the generation lets a watcher notice changes without comparing entries
+        if changed:
+            catalog['generation'] += 1
+            catalog['changed'] = True
+
+        # only a complete catalog is shared, since saving the WHOIS cache
+        # drops every IP the catalog does not list
+        _catalogs[name] = catalog
+        return catalog
+
+# the catalog of a log directory as this run left it, refreshing it if no
+# collector has yet
+def get_catalog(log_dir):
+
+    with _catalog_lock:
+        return _catalogs.get(get_state_name('catalog', log_dir)) or refresh_catalog(log_dir)
+
+# write the catalog back if this run changed it
+def save_catalog(log_dir=PSAD_LOG_DIR):
+
+    name = get_state_name('catalog', log_dir)
+    catalog = _catalogs.get(name)
+    if catalog and catalog.pop('changed', False):
+        save_state(name, catalog)
+
+# the alert fields we report, matched without lowercasing every line
+first_seen_re = re.compile('overall scan start:', flags=re.IGNORECASE)
+source_re = re.compile('source:', flags=re.IGNORECASE)
+tcp_ports_re = re.compile('scanned tcp ports', flags=re.IGNORECASE)
+port_range_re = re.compile('\\[(.+?):')
+
+# read the fields we report from an alert file; they all sit in the first
+# alert block, so stop as soon as they are found or after ALERT_READ_LIMIT
+# bytes, however much psad has appended since
+def parse_email_alert(file):
+
+    first_seen = '?'
+    IP = '?'
+    ports = '?'
+    bytes_read = 0
+
+    count('files_opened')
+    with open(file, 'r') as f:
+
+        for line in f:
+            bytes_read += len(line)
+            if first_seen == '?' and first_seen_re.search(line):
+                first_seen = line.split(": ", 1)[1].strip()
+            if IP == '?' and source_re.search(line):
+                IP = line.split(": ", 1)[1].strip()
+            if ports == '?' and tcp_ports_re.search(line):
+                ports = port_range_re.search(line).group(1)
+            if '?' not in (first_seen, IP, ports) or bytes_read >= ALERT_READ_LIMIT:
+                break
+
+    count('bytes_read', bytes_read)
+    return [first_seen, IP, ports]
+
+# the port lists psad writes in each alert, e.g. "Scanned UDP ports: [53: 1 packets]"
+scanned_ports_re = re.compile(b'scanned (tcp|udp) ports: *\\[([0-9,\\- ]+)', flags=re.IGNORECASE)
+PORT_PROTOCOLS = ('tcp', 'udp')
+
+# sort and merge [low, high] port ranges so overlapping and adjacent ones
+# become one
+def merge_ranges(ranges):
+
+    merged = []
+    for low, high in sorted(ranges):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    return merged
+
+# the [low, high] ranges in a psad port list such as "22-33" or "80,443"
+def parse_port_ranges(text):
+
+    ranges = []
+    for item in text.split(b','):
+        bounds = item.split(b'-', 1)
+        try:
+            low = int(bounds[0])
+            high = int(bounds[-1])
+        except ValueError:
+            continue
+        if 0 <= low <= high <= 65535:
+            ranges.append([low, high])
+    return ranges
+
+# bring an alert file's TCP and UDP port ranges up to date; ports is
+# [inode, offset, mtime, tcp ranges, udp ranges] from the last run, and
+# since psad only appends, just the new bytes are read
+def update_alert_ports(file, ports, mtime):
+
+    count('files_opened')
+    with open(file, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if not ports or ports[0] != stat.st_ino or ports[1] > stat.st_size:
+            ports = [stat.st_ino, 0, None, [], []]
+        if ports[1] == stat.st_size:
+            return [ports[0], ports[1], mtime, ports[3], ports[4]], ports[2] != mtime
+
+        found = dict((protocol, []) for protocol in PORT_PROTOCOLS)
+        offset = ports[1]
+        f.seek(offset)
+        rest = b''
+        while True:
+            chunk = f.read(ALERT_READ_LIMIT)
+            if not chunk:
+                break
+            count('bytes_read', len(chunk))
+            # a line psad is still writing is left for the next run
+            data = rest + chunk
+            end = data.rfind(b'\n') + 1
+            for match in scanned_ports_re.finditer(data[:end]):
+                found[match.group(1).lower().decode('ascii')].extend(parse_port_ranges(match.group(2)))
+            rest = data[end:]
+            offset += end
+
+    return [ports[0], offset, mtime, merge_ranges(ports[3] + found['tcp']), merge_ranges(ports[4] + found['udp'])], True
+
+# refresh the port ranges of one cataloged IP, opening the alert file only
+# when the catalog saw it change; True if they changed
+def refresh_alert_ports(log_dir, ip, entry):
+
+    if entry[ALERT_PORTS] and entry[ALERT_PORTS][2] == entry[ALERT_MTIME]:
+        return False
+
+    try:
+        ports, changed = update_alert_ports(os.path.join(log_dir, ip, entry[ALERT_NAME]), entry[ALERT_PORTS], entry[ALERT_MTIME])
+    except (IOError, OSError):
+        count('dropped')
+        return False
+    entry[ALERT_PORTS] = ports
+    return changed
+
+# how many attackers targeted each port, per protocol; each attacker's
+# ports are kept as merged ranges, so the counts come from a difference
+# array over the range ends rather than from a set of ports per attacker
+def get_port_heatmap(sensors, buckets=1024, top=20):
+
+    attacker_ports = {}
+    for sensor, log_dir in sensors:
+        catalog = get_catalog(log_dir)
+        items = [(ip, entry) for ip, entry in catalog['ips'].items() if entry[ALERT_NAME] and is_reported_ip(ip)]
+        if any(parallel_map(lambda item: refresh_alert_ports(log_dir, item[0], item[1]), items)):
+            catalog['changed'] = True
+        save_catalog(log_dir)
+        for ip, entry in items:
+            if entry[ALERT_PORTS]:
+                attacker_ports.setdefault(ip, []).append(entry[ALERT_PORTS])
+
+    heatmap = []
+    width = 65536 // buckets
+    for index, protocol in enumerate(PORT_PROTOCOLS, 3):
+        counts = [0] * 65537
+        attackers = 0
+        for port_lists in attacker_ports.values():
+            # an IP seen by several sensors counts once per port
+            ranges = port_lists[0][index] if len(port_lists) == 1 else merge_ranges([r for ports in port_lists for r in ports[index]])
+            if ranges:
+                attackers += 1
+            for low, high in ranges:
+                counts[low] += 1
+                counts[high + 1] -= 1
+
+        running = 0
+        for port in range(65536):
+            running += counts[port]
+            counts[port] = running
+        del counts[65536]
+
+        count('records')
+        heatmap.append({
+            "protocol": protocol,
+            "attackers": attackers,
+            "ports": sum(1 for attacks in counts if attacks),
+            "buckets": [max(counts[start:start + width]) for start in range(0, 65536, width)],
+            "top": [[port, counts[port]] for port in heapq.nlargest(top, range(65536), key=counts.__getitem__) if counts[port]]
+        })
+
+    return heatmap
+
+# imperfect science of extracting info from WHOIS data
+country_re = re.compile('^country:', flags=re.IGNORECASE)
+host_re = re.compile('^(org-name|organi|owner:|netname)', flags=re.IGNORECASE)
+
+# WHOIS entries are [size, mtime, country, host] keyed by IP
+WHOIS_VERSION = 1
+_whois_caches = {}
+_whois_lock = threading.Lock()
+
+# get the WHOIS cache for a log directory, loading it on first use
+def get_whois_cache(log_dir=PSAD_LOG_DIR):
+
+    name = get_state_name('whois', log_dir)
+    with _whois_lock:
+        cache = _whois_caches.get(name)
+        if cache is None:
+            cache = load_state(name)
+            if not cache or cache.get('version') != WHOIS_VERSION:
+                cache = {'version': WHOIS_VERSION, 'ips': {}}
+            _whois_caches[name] = cache
+    return cache
+
+# read the country and hosting provider from a WHOIS file
+def parse_whois(whois_file):
+
+    country = '?'
+    host = ['?']
+
+    count('files_opened')
+    with open(whois_file, 'r') as f:
+        for line in f:
+            count('bytes_read', len(line))
+            if country == '?' and country_re.match(line):
+                country = line.split(None, 1)[1][:2]
+            if ' ' in line and host_re.match(line):
+                host.append(line.split(None, 1)[1])
+
+    return country, max(host, key=len)
+
+# get (country, host) for an IP, or None if psad has no WHOIS file for it
+def get_whois_info(IP, log_dir=PSAD_LOG_DIR):
+
+    whois_file = os.path.join(log_dir, IP, IP + '_whois')
+    try:
+        count('files_stated')
+        stat = os.stat(whois_file)
+    except OSError:
+        return None
+
+    cache = get_whois_cache(log_dir)
+    entry = cache['ips'].get(IP)
+    if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+        return entry[2], entry[3]
+
+    country, host = parse_whois(whois_file)
+    cache['ips'][IP] = [stat.st_size, stat.st_mtime, country, host]
+    cache['changed'] = True
+    return country, host
+
+# write the WHOIS cache back, dropping IPs psad has expired
+def save_whois_cache(log_dir=PSAD_LOG_DIR):
+
+    name = get_state_name('whois', log_dir)
+    cache = _whois_caches.get(name)
+    if not cache:
+        return
+
+    catalog = _catalogs.get(get_state_name('catalog', log_dir))
+
+    # other collectors may still be adding entries, so save a copy
+    with _whois_lock:
+        if catalog:
+            for IP in list(cache['ips']):
+                if IP not in catalog['ips']:
+                    del cache['ips'][IP]
+                    cache['changed'] = True
+        if not cache.pop('changed', False):
+            return
+        data = {'version': cache['version'], 'ips': dict(cache['ips'])}
+
+    save_state(name, data)
+
+# country values that mean the database does not know the country
+GEOIP_NO_COUNTRY = ('', 'NONE', 'UNKNOWN', 'ZZ', '-', '--')
+
+# column names accepted in a GeoIP CSV header, mapped to what we use
+GEOIP_COLUMNS = {
+    'network': 'network',
+    'cidr': 'network',
+    'start': 'start',
+    'range_start': 'start',
+    'end': 'end',
+    'range_end': 'end',
+    'country': 'country',
+    'country_code': 'country',
+    'country_iso_code': 'country',
+    'asn': 'asn',
+    'as_number': 'asn',
+    'autonomous_system_number': 'asn',
+    'org': 'org',
+    'organization': 'org',
+    'as_description': 'org',
+    'autonomous_system_organization': 'org'
+}
+
+# the loaded GeoIP database, set up by load_geoip()
+_geoip = None
+
+# an array type that holds 32-bit values, for compact IPv4 ranges
+def get_ipv4_array():
+
+    for typecode in ('I', 'L'):
+        if array.array(typecode).itemsize >= 4:
+            return array.array(typecode)
+
+# read the rows of a GeoIP range file as (network spec or (start, end),
+# country, asn, org); a headerless tab separated file is read in the
+# iptoasn.com layout of start, end, asn, country, description
+def read_geoip_rows(file):
+
+    with open(file, 'r') as f:
+        first = f.readline()
+        delimiter = '\t' if '\t' in first else ','
+        header = [column.strip().lower() for column in first.split(delimiter)]
+
+        if any(column in GEOIP_COLUMNS for column in header):
+            columns = [GEOIP_COLUMNS.get(column) for column in header]
+            lines = f
+        else:
+            columns = ['start', 'end', 'asn', 'country', 'org']
+            lines = itertools.chain([first], f)
+
+        for row in csv.reader(lines, delimiter=delimiter):
+            fields = dict((column, value.strip()) for column, value in zip(columns, row) if column)
+            if 'network' in fields:
+                network = fields['network']
+            elif 'start' in fields and 'end' in fields:
+                network = (fields['start'], fields['end'])
+            else:
+                continue
+            country = fields.get('country') or ''
+            if country.upper() in GEOIP_NO_COUNTRY:
+                country = '?'
+            yield network, country, fields.get('asn') or '', fields.get('org') or ''
+
+# load an IP range database into sorted arrays per family; each range
+# points into a table of distinct (country, host) pairs
+def load_geoip(file):
+
+    global _geoip
+
+    if file.endswith('.mmdb'):
+        if maxminddb is None:
+            raise ValueError('reading ' + file + ' needs the maxminddb module')
+        _geoip = maxminddb.open_database(file)
+        return
+
+    ranges = dict((family, []) for family in ADDRESS_BITS)
+    values = {}
+    for network, country, asn, org in read_geoip_rows(file):
+        try:
+            if isinstance(network, tuple):
+                first = parse_ip(network[0])
+                last = parse_ip(network[1])
+                if first is None or last is None or first[0] != last[0]:
+                    continue
+                family, first, last = first[0], first[1], last[1]
+            else:
+                family, first, last = parse_network(network)
+        except ValueError:
+            continue
+
+        asn = asn.upper().replace('AS', '')
+        # iptoasn lists unrouted space as AS0; it says nothing about the
+        # IP, so leave it to the WHOIS files
+        if asn == '0' and org.lower() == 'not routed':
+            continue
+        if asn in ('', '0'):
+            host = org or '?'
+        else:
+            host = ('AS' + asn + ' ' + org).strip()
+        value = (country[:2], host)
+        ranges[family].append((first, last, values.setdefault(value, len(values))))
+
+    table = [None] * len(values)
+    for value, index in values.items():
+        table[index] = value
+
+    _geoip = {'values': table}
+    for family, family_ranges in ranges.items():
+        family_ranges.sort()
+        starts = get_ipv4_array() if family == socket.AF_INET else []
+        ends = get_ipv4_array() if family == socket.AF_INET else []
+        indexes = array.array('I' if array.array('I').itemsize >= 4 else 'L')
+        for first, last, index in family_ranges:
+            starts.append(first)
+            ends.append(last)
+            indexes.append(index)
+        _geoip[family] = (starts, ends, indexes)
+
+# (country, host) for an IP from the GeoIP database, or None
+def lookup_geoip(IP):
+
+    if _geoip is None:
+        return None
+
+    if not isinstance(_geoip, dict):
+        record = _geoip.get(IP) or {}
+        country = (record.get('country') or record.get('registered_country') or {}).get('iso_code')
+        asn = record.get('autonomous_system_number')
+        org = record.get('autonomous_system_organization') or ''
+        if not country and not asn:
+            return None
+        host = ('AS' + str(asn) + ' ' + org).strip() if asn else (org or '?')
+        return country or '?', host
+
+    ip = parse_ip(IP)
+    if ip is None:
+        return None
+    starts, ends, indexes = _geoip[ip[0]]
+    i = bisect.bisect_right(starts, ip[1]) - 1
+    if i < 0 or ip[1] > ends[i]:
+        return None
+    return _geoip['values'][indexes[i]]
+
+# (country, host) for an IP from the GeoIP database when one is loaded,
+# filling any gaps from psad's WHOIS file; None if neither knows the IP
+def get_ip_info(IP, log_dir=PSAD_LOG_DIR):
+
+    geo = lookup_geoip(IP)
+    if geo is not None and '?' not in geo:
+        return geo
+
+    whois = get_whois_info(IP, log_dir)
+    if geo is None or whois is None:
+        return geo or whois
+    return (geo[0] if geo[0] != '?' else whois[0]), (geo[1] if geo[1] != '?' else whois[1])
+
+# build the last attacks row for one cataloged IP, or None to skip it
+def get_last_attack(ip, catalog, log_dir):
+
+    entry = catalog['ips'][ip]
+    file_dir = os.path.join(log_dir, ip)
+    try:
+        # attacks without WHOIS or GeoIP data are left out of this table
+        info = get_ip_info(ip, log_dir)
+        if info is None:
+            return None
+        country = info[0]
+
+        if entry[ALERT_FIELDS] is None:
+            entry[ALERT_FIELDS] = parse_email_alert(os.path.join(file_dir, entry[ALERT_NAME]))
+            catalog['changed'] = True
+        first_seen, IP, ports = entry[ALERT_FIELDS]
+
+        return {
+            "last_seen": time.ctime(entry[ALERT_MTIME]),
+            "first_seen": first_seen,
+            "IP": IP,
+            "country": country,
+            "ports": ports
+        }
+
+    except:
+        count('dropped')
+        return None
 
 # compile the latest attacks
-def get_last_attacks():
+def get_last_attacks(limit=20, log_dir=PSAD_LOG_DIR):
 
     last_attacks = []
 
-    # used to skip private IP ranges
-    internal_ip_re = re.compile('^(?:10|127|172\.(?:1[6-9]|2[0-9]|3[01])|192\.168)\..*')
+    catalog = refresh_catalog(log_dir)
 
-    # PSAD IP log files sorted by date
-    files = sorted(glob.iglob('/var/log/psad/*/*_email_alert'), key=os.path.getmtime, reverse=True)
+    # newest alert files first without sorting the whole tree
+    heap = [(-entry[ALERT_MTIME], ip) for ip, entry in catalog['ips'].items()
+            if entry[ALERT_MTIME] is not None and is_reported_ip(ip)]
+    heapq.heapify(heap)
 
-    # imperfect science of extracting info from WHOIS data
-    country_re = re.compile('^country:', flags=re.IGNORECASE)
+    # look at just enough of the newest candidates to fill the table,
+    # fanning the reads out while keeping the order deterministic
+    while heap and len(last_attacks) < limit:
+        batch = [heapq.heappop(heap)[1] for i in range(min(limit - len(last_attacks), len(heap)))]
+        for attack in parallel_map(lambda ip: get_last_attack(ip, catalog, log_dir), batch):
+            if attack is not None:
+                last_attacks.append(attack)
 
-    # get the directories named after valid IPs only
-    for file in files:
-        if not os.path.isdir(file):
-            try:
-                file_dir = os.path.dirname(file)
-                socket.inet_pton(socket.AF_INET, os.path.basename(file_dir))
-                if not internal_ip_re.match(os.path.basename(file_dir)):
-
-                    last_seen = time.ctime(os.path.getmtime(file))
-                    first_seen = '?'
-                    IP = '?'
-                    country = '?'
-                    ports = '?'
-
-                    whois_file = file_dir + "/" + os.path.basename(file_dir) + "_whois"
-
-                    with open(whois_file, 'r') as f:
-                        for line in f:
-                            if country == '?' and country_re.match(line):
-                                country = line.split(None, 1)[1][:2]
-
-                    with open(file, 'r') as f:
-
-                        for line in f.readlines():
-                            if first_seen == '?' and "overall scan start:" in line.lower():
-                                first_seen = line.split(": ", 1)[1]
-                            if IP == '?' and "source:" in line.lower():
-                                IP = line.split(": ", 1)[1]
-                            if ports == '?' and "scanned tcp ports" in line.lower():
-                                ports = re.search('\[(.+?):', line).group(1)
-
-                        attacker_dict = {
-                            "last_seen": last_seen,
-                            "first_seen": first_seen,
-                            "IP": IP,
-                            "country": country,
-                            "ports": ports
-                        }
-                        last_attacks.append(attacker_dict)
-
-            except:
-                pass
-            if len(last_attacks) == 20:
-                break
+    save_catalog(log_dir)
+    save_whois_cache(log_dir)
 
     return last_attacks
 
-# parse the top attackers file
-def get_top_attackers():
+# rows of the top_* files and of the top attackers table; hits are ints
+Attacker = collections.namedtuple('Attacker', 'last_seen IP hits country host')
+Signature = collections.namedtuple('Signature', 'SID sig hits')
+Port = collections.namedtuple('Port', 'port_num hits')
 
-    top_attackers = []
-    raw_attackers = None
+# last consistent records parsed from each top_* file, by path
+_snapshots = {}
 
-    # imperfect science of extracting info from WHOIS data
-    country_re = re.compile('^country:', flags=re.IGNORECASE)
-    host_re = re.compile('^(org-name|organi|owner:|netname)', flags=re.IGNORECASE)
+# the start of the cache file names of the records saved from a top_* file
+def get_snapshot_prefix(file):
 
-    # used to skip private IP ranges
-    internal_ip_re = re.compile('^(?:10|127|172\.(?:1[6-9]|2[0-9]|3[01])|192\.168)\..*')
+    return get_state_name('snapshot', file)[:-len('.json')] + '-'
 
-    # using this while loop to get around instances where no data comes back
-    # possibly due to the file being in use and locked
-    while not raw_attackers:
-        with open('/var/log/psad/top_attackers', 'r') as f:
-            raw_attackers = f.readlines()
+# save the records of a top_* file under a name made from the inode, size
+# and mtime they were read at, unless that version is saved already; the
+# name tells versions apart without comparing psad's clock with ours
+def save_snapshot(file, stat, records):
 
-    for attacker in raw_attackers:
-        if attacker[0].isdigit():
+    if not CACHE_DIR:
+        return
 
+    prefix = get_snapshot_prefix(file)
+    version = repr((stat.st_ino, stat.st_size, stat.st_mtime)).encode('utf-8')
+    name = prefix + hashlib.sha1(version).hexdigest()[:12] + '.json'
+    count('files_stated')
+    if os.path.exists(os.path.join(CACHE_DIR, name)):
+        return
+
+    save_state(name, records)
+    if not os.path.exists(os.path.join(CACHE_DIR, name)):
+        return
+    for other in os.listdir(CACHE_DIR):
+        if other.startswith(prefix) and other != name:
             try:
-                IP = attacker.split()[0]
-                hits = attacker.split()[2]
-                country = '?'
-                host = ['?']
-                last_seen = '?'
-                path = '/var/log/psad/' + IP
-                whois_file = path + '/' + IP + '_whois'
-
-                if not internal_ip_re.match(IP):
-                    if os.path.isfile(whois_file):
-                        with open(whois_file, 'r') as f:
-                            for line in f:
-                                if country == '?' and country_re.match(line):
-                                    country = line.split(None, 1)[1][:2]
-                                if ' ' in line and host_re.match(line):
-                                    host.append(line.split(None, 1)[1])
-
-                    for file in os.listdir(path):
-                        if file.endswith('_email_alert'):
-                            file_path = os.path.join(path, file)
-                            last_seen = time.ctime(os.path.getmtime(file_path))
-
-                    attacker_dict = {
-                        "last_seen": last_seen,
-                        "IP": IP,
-                        "hits": hits,
-                        "country": country,
-                        "host": max(host, key=len)
-                    }
-                    top_attackers.append(attacker_dict)
-            except:
+                os.remove(os.path.join(CACHE_DIR, other))
+            except OSError:
                 pass
 
+# the records last saved from a top_* file, or None
+def load_snapshot(file):
+
+    if not CACHE_DIR:
+        return None
+
+    prefix = get_snapshot_prefix(file)
+    try:
+        names = [name for name in os.listdir(CACHE_DIR) if name.startswith(prefix)]
+    except OSError:
+        return None
+    names.sort(key=lambda name: os.path.getmtime(os.path.join(CACHE_DIR, name)), reverse=True)
+    for name in names:
+        records = load_state(name)
+        if records is not None:
+            return records
+    return None
+
+# parse a file psad rewrites in place once it holds still, backing off
+# while it is being written and falling back to the last good records,
+# which are also kept in the cache directory for the next run; parse
+# turns an iterable of lines into records, record rebuilds a saved one
+def read_snapshot(file, parse, record=tuple, empty=False, retries=SNAPSHOT_RETRIES, delay=0.05, max_delay=1.0):
+
+    for attempt in range(retries):
+        if attempt:
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+        try:
+            count('files_opened')
+            with open(file, 'r') as f:
+                before = os.fstat(f.fileno())
+                records = list(parse(f))
+            count('bytes_read', before.st_size)
+            count('files_stated')
+            after = os.stat(file)
+        except (IOError, OSError):
+            continue
+
+        # the file only holds still if nothing changed while it was read,
+        # which does not depend on the clocks of psad's host and ours
+        if (before.st_ino, before.st_size, before.st_mtime) != (after.st_ino, after.st_size, after.st_mtime):
+            continue
+        # psad truncates before writing, so only the files that can be
+        # empty are taken as they are
+        if not before.st_size and not empty:
+            continue
+
+        _snapshots[file] = records
+        save_snapshot(file, after, records)
+        return records
+
+    if file in _snapshots:
+        return _snapshots[file]
+    saved = load_snapshot(file)
+    if saved is not None:
+        return [record(fields) for fields in saved]
+
+    # nothing to fall back to, so take the file as it is now
+    count('files_opened')
+    with open(file, 'r') as f:
+        return list(parse(f))
+
+# look up the top attackers row for one IP, its last-seen time coming from
+# the catalog of its log directory; None to skip it
+def get_top_attacker(IP, hits, log_dir, catalog):
+
+    try:
+        country = '?'
+        host = '?'
+        last_seen = '?'
+
+        info = get_ip_info(IP, log_dir)
+        if info is not None:
+            country, host = info
+
+        # psad may list IPs whose directories it has since cleaned up
+        entry = catalog['ips'].get(IP)
+        if entry is None:
+            count('dropped')
+            return None
+        if entry[ALERT_MTIME] is not None:
+            last_seen = time.ctime(entry[ALERT_MTIME])
+
+        return Attacker(last_seen, IP, hits, country, host)
+    except:
+        count('dropped')
+        return None
+
+# parse top_attackers lines into (IP, hits) for the public IPs
+def iter_attacker_candidates(lines):
+
+    for line in lines:
+        if line[:1].isdigit():
+
+            try:
+                fields = line.split(None, 3)
+                if is_reported_ip(fields[0]):
+                    yield fields[0], int(fields[2])
+            except (IndexError, ValueError):
+                count('dropped')
+
+# rank the top attackers file on its cheap columns, returning the public
+# IPs and their hits in file order
+def get_attacker_candidates(log_dir=PSAD_LOG_DIR):
+
+    # psad may be rewriting the file, which used to come back empty
+    return read_snapshot(os.path.join(log_dir, 'top_attackers'), iter_attacker_candidates)
+
+# look up the highest ranked (IP, hits, log_dir) candidates until limit of
+# them succeed; file order breaks ties
+def enrich_attackers(candidates, limit=TOP_ATTACKERS):
+
+    top_attackers = []
+    heap = [(-hits, order, IP, log_dir) for order, (IP, hits, log_dir) in enumerate(candidates)]
+    heapq.heapify(heap)
+
+    # the last-seen times come from the catalogs, fetched here because the
+    # lookups run on the pool a catalog refresh would need
+    catalogs = dict((log_dir, get_catalog(log_dir)) for log_dir in set(candidate[2] for candidate in candidates))
+
+    # only the attackers that make the cut get WHOIS and last-seen lookups
+    while heap and (limit is None or len(top_attackers) < limit):
+        wanted = len(heap) if limit is None else limit - len(top_attackers)
+        batch = [heapq.heappop(heap) for i in range(min(wanted, len(heap)))]
+        for attacker in parallel_map(lambda candidate: get_top_attacker(candidate[2], -candidate[0], candidate[3], catalogs[candidate[3]]), batch):
+            if attacker is not None:
+                top_attackers.append(attacker)
+
     return top_attackers
 
-# parse the top signatures file
-def get_top_signatures():
+# the candidates the last top attackers collection ranked, by log
+# directory, so the history counts the same attackers as the report
+_candidates = {}
+
+# parse the top attackers file
+def get_top_attackers(limit=TOP_ATTACKERS, log_dir=PSAD_LOG_DIR):
+
+    _candidates[log_dir] = get_attacker_candidates(log_dir)
+    candidates = [(IP, hits, log_dir) for IP, hits in _candidates[log_dir]]
+    top_attackers = enrich_attackers(candidates, limit)
 
-    top_signatures = []
+    save_whois_cache(log_dir)
 
-    with open('/var/log/psad/top_sigs', 'r') as f:
-        raw_signatures = f.readlines()
+    return top_attackers
 
-    for signature in raw_signatures:
-        if signature[0].isdigit():
+# parse top_sigs lines, SID "signature" hits ..., into Signature records;
+# splitting on the quotes leaves the SID first, the signature text at the
+# odd positions and the counters last
+def iter_signatures(lines):
+
+    for line in lines:
+        if line[:1].isdigit():
 
             try:
-                sid = signature.split()[0]
-                sig = ' '.join(re.findall(r'"(.*?)"', signature))
-                hits = ' '.join(signature.split('"')[-1:]).split()[0]
-
-                sig_dict = {
-                    "SID": sid,
-                    "sig": sig,
-                    "hits": hits
-                }
-                top_signatures.append(sig_dict)
-            except:
-                pass
+                parts = line.split('"')
+                yield Signature(parts[0].split(None, 1)[0], ' '.join(parts[1:-1:2]), int(parts[-1].split(None, 1)[0]))
+            except (IndexError, ValueError):
+                count('dropped')
+
+# parse top_ports lines into Port records for the TCP ports
+def iter_ports(lines):
+
+    for line in lines:
+        if line.startswith('tcp'):
+
+            try:
+                fields = line.split(None, 3)
+                if fields[0] == 'tcp':
+                    yield Port(fields[1], int(fields[2]))
+            except (IndexError, ValueError):
+                count('dropped')
+
+# parse the top signatures file
+def get_top_signatures(log_dir=PSAD_LOG_DIR):
 
-    return top_signatures
+    return read_snapshot(os.path.join(log_dir, 'top_sigs'), iter_signatures, Signature._make, True)
 
 # parse the top ports file
-def get_top_ports():
+def get_top_ports(log_dir=PSAD_LOG_DIR):
 
-    top_ports = []
+    return read_snapshot(os.path.join(log_dir, 'top_ports'), iter_ports, Port._make, True)
 
-    with open('/var/log/psad/top_ports', 'r') as f:
-        raw_ports = f.readlines()
+# where an IP in the tables links to: its detail page under pages_url when
+# there are detail pages, the WHOIS site otherwise
+def get_ip_url(IP, pages_url=None):
 
-    for port in raw_ports:
-        if port[0].isalpha():
+    if pages_url is not None:
+        return pages_url + get_page_name(IP)
+    return 'https://www.whois.com/whois/' + IP
 
-            try:
-                if port.split()[0] == 'tcp':
-                    port_num = port.split()[1]
-                    hits = port.split()[2]
+# the OSINT sites linked for each IP, as URL prefixes for the IP
+OSINT_SITES = ('https://dnslytics.com/ip/', 'https://www.virustotal.com/gui/ip-address/', 'https://www.abuseipdb.com/check/')
 
-                    port_dict = {
-                        "port_num": port_num,
-                        "hits": hits
-                    }
-                    top_ports.append(port_dict)
-            except:
-                pass
+# links to the OSINT sites for an IP
+def get_osint_links(IP):
+
+    return '&nbsp;'.join('[<a href="' + site + IP + '" target="_blank">' + str(i + 1) + '</a>]' for i, site in enumerate(OSINT_SITES))
 
-    return top_ports
+# the OSINT sites for the pages that build their links in the browser
+def get_osint_javascript():
 
-# create last attacks HTML table
-def get_last_attacks_html(last_attacks):
+    return 'var OSINT_SITES = ' + json.dumps(OSINT_SITES) + ';'
 
-    last_attacks_html = '<table class="psadTable" id="lastAttacksTable">'
-    last_attacks_html += '<tr class="psadTableRow">'
-    last_attacks_html += '<td class="psadTableHead">Last Seen</td>'
-    last_attacks_html += '<td class="psadTableHead">First Seen</td>'
-    last_attacks_html += '<td class="psadTableHead">IP Address</td>'
-    last_attacks_html += '<td class="psadTableHead">Country</td>'
-    last_attacks_html += '<td class="psadTableHead">Ports Targeted</td>'
-    last_attacks_html += '<td class="psadTableHead">OSINT Links</td>'
-    last_attacks_html += '</tr>'
+# stream the last attacks HTML table
+def iter_last_attacks_html(last_attacks, pages_url=None):
+
+    yield ('<table class="psadTable" id="lastAttacksTable">'
+           '<tr class="psadTableRow">'
+           '<td class="psadTableHead">Last Seen</td>'
+           '<td class="psadTableHead">First Seen</td>'
+           '<td class="psadTableHead">IP Address</td>'
+           '<td class="psadTableHead">Country</td>'
+           '<td class="psadTableHead">Ports Targeted</td>'
+           '<td class="psadTableHead">OSINT Links</td>'
+           '</tr>')
 
     for attack in last_attacks:
 
-        IP_link = '<a href="https://www.whois.com/whois/' + attack['IP'] + '" target="_blank">'
-        IP_link += attack['IP'] + '</a>'
-
-        OSINT_links = '[<a href="https://dnslytics.com/ip/' + attack['IP'] + '" target="_blank">1</a>]&nbsp;'
-        OSINT_links += '[<a href="https://www.virustotal.com/gui/ip-address/' + attack['IP'] + '" target="_blank">2</a>]&nbsp;'
-        OSINT_links += '[<a href="https://www.abuseipdb.com/check/' + attack['IP'] + '" target="_blank">3</a>]'
-
-        last_attacks_html += '<tr class="psadTableRow">'
-        last_attacks_html += '<td class="psadTableCell">' + attack['last_seen'] + '</td>'
-        last_attacks_html += '<td class="psadTableCell">' + attack['first_seen'] + '</td>'
-        last_attacks_html += '<td class="psadTableCell">' + IP_link + '</td>'
-        last_attacks_html += '<td class="psadTableCell">' + attack['country'] + '</td>'
-        last_attacks_html += '<td class="psadTableCell">' + attack['ports'] + '</td>'
-        last_attacks_html += '<td class="psadTableCell">' + OSINT_links + '</td>'
-        last_attacks_html += '</tr>'
-
-    last_attacks_html += '</table>'
-    return last_attacks_html
-
-# create top attackers HTML table
-def get_attackers_html(top_attackers):
-
-    top_attackers = sorted(top_attackers, key=lambda x: int(x['hits']), reverse=True)
-    rows = 50 if len(top_attackers) > 50 else len(top_attackers)
-
-    top_attackers_html = '<table class="psadTable" id="attackerTable">'
-    top_attackers_html += '<tr class="psadTableRow">'
-    top_attackers_html += '<td class="psadTableHead">Last Seen</td>'
-    top_attackers_html += '<td class="psadTableHead">Hits</td>'
-    top_attackers_html += '<td class="psadTableHead">IP Address</td>'
-    top_attackers_html += '<td class="psadTableHead">Country</td>'
-    top_attackers_html += '<td class="psadTableHead">Hosting Provider</td>'
-    top_attackers_html += '<td class="psadTableHead">OSINT Links</td>'
-    top_attackers_html += '</tr>'
-
-    for attacker in top_attackers[:rows]:
-
-        IP_link = '<a href="https://www.whois.com/whois/' + attacker['IP'] + '" target="_blank">'
-        IP_link += attacker['IP'] + '</a>'
-
-        OSINT_links = '[<a href="https://dnslytics.com/ip/' + attacker['IP'] + '" target="_blank">1</a>]&nbsp;'
-        OSINT_links += '[<a href="https://www.virustotal.com/gui/ip-address/' + attacker['IP'] + '" target="_blank">2</a>]&nbsp;'
-        OSINT_links += '[<a href="https://www.abuseipdb.com/check/' + attacker['IP'] + '" target="_blank">3</a>]'
-
-        top_attackers_html += '<tr class="psadTableRow">'
-        top_attackers_html += '<td class="psadTableCell">' + attacker['last_seen'] + '</td>'
-        top_attackers_html += '<td class="psadTableCell">' + attacker['hits'] + '</td>'
-        top_attackers_html += '<td class="psadTableCell">' + IP_link + '</td>'
-        top_attackers_html += '<td class="psadTableCell">' + attacker['country'].upper() + '</td>'
-        top_attackers_html += '<td class="psadTableCellLeft">' + attacker['host'] + '</td>'
-        top_attackers_html += '<td class="psadTableCell">' + OSINT_links + '</td>'
-        top_attackers_html += '</tr>'
-
-    top_attackers_html += '</table>'
-    return top_attackers_html
-
-def get_signatures_html(top_signatures):
-
-    top_signatures_html = '<table class="psadTable" id="signatureTable">'
-    top_signatures_html += '<tr class="psadTableRow">'
-    top_signatures_html += '<td class="psadTableHead">Hits</td>'
-    top_signatures_html += '<td class="psadTableHead">SID</td>'
-    top_signatures_html += '<td class="psadTableHead">Signature</td>'
-    top_signatures_html += '</tr>'
+        count('records')
+        yield ''.join((
+            '<tr class="psadTableRow">',
+            '<td class="psadTableCell">', attack['last_seen'], '</td>',
+            '<td class="psadTableCell">', attack['first_seen'], '</td>',
+            '<td class="psadTableCell"><a href="', get_ip_url(attack['IP'], pages_url), '" target="_blank">', attack['IP'], '</a></td>',
+            '<td class="psadTableCell">', attack['country'], '</td>',
+            '<td class="psadTableCell">', attack['ports'], '</td>',
+            '<td class="psadTableCell">', get_osint_links(attack['IP']), '</td>',
+            '</tr>'
+        ))
+
+    yield '</table>'
+
+# stream the top attackers HTML table
+def iter_attackers_html(top_attackers, limit=TOP_ATTACKERS, pages_url=None):
+
+    top_attackers = sorted(top_attackers, key=lambda attacker: attacker.hits, reverse=True)
+
+    yield ('<table class="psadTable" id="attackerTable">'
+           '<tr class="psadTableRow">'
+           '<td class="psadTableHead">Last Seen</td>'
+           '<td class="psadTableHead">Hits</td>'
+           '<td class="psadTableHead">IP Address</td>'
+           '<td class="psadTableHead">Country</td>'
+           '<td class="psadTableHead">Hosting Provider</td>'
+           '<td class="psadTableHead">OSINT Links</td>'
+           '</tr>')
+
+    for attacker in top_attackers[:limit]:
+
+        count('records')
+        yield ''.join((
+            '<tr class="psadTableRow">',
+            '<td class="psadTableCell">', attacker.last_seen, '</td>',
+            '<td class="psadTableCell">', str(attacker.hits), '</td>',
+            '<td class="psadTableCell"><a href="', get_ip_url(attacker.IP, pages_url), '" target="_blank">', attacker.IP, '</a></td>',
+            '<td class="psadTableCell">', attacker.country.upper(), '</td>',
+            '<td class="psadTableCellLeft">', attacker.host, '</td>',
+            '<td class="psadTableCell">', get_osint_links(attacker.IP), '</td>',
+            '</tr>'
+        ))
+
+    yield '</table>'
+
+# stream the top signatures HTML table
+def iter_signatures_html(top_signatures):
+
+    yield ('<table class="psadTable" id="signatureTable">'
+           '<tr class="psadTableRow">'
+           '<td class="psadTableHead">Hits</td>'
+           '<td class="psadTableHead">SID</td>'
+           '<td class="psadTableHead">Signature</td>'
+           '</tr>')
 
     for signature in top_signatures:
 
-        sig_link = '<a href="https://www.google.com/search?q=' + urllib.quote_plus(signature['sig'])
-        sig_link += '" target="_blank">' + signature['sig'] + '</a>'
+        count('records')
+        yield ''.join((
+            '<tr class="psadTableRow">',
+            '<td class="psadTableCell">', str(signature.hits), '</td>',
+            '<td class="psadTableCell">', signature.SID, '</td>',
+            '<td class="psadTableCellLeft"><a href="https://www.google.com/search?q=', quote_plus(signature.sig),
+            '" target="_blank">', signature.sig, '</a></td>',
+            '</tr>'
+        ))
+
+    yield '</table>'
 
-        top_signatures_html += '<tr class="psadTableRow">'
-        top_signatures_html += '<td class="psadTableCell">' + signature['hits'] + '</td>'
-        top_signatures_html += '<td class="psadTableCell">' + signature['SID'] + '</td>'
-        top_signatures_html += '<td class="psadTableCellLeft">' + sig_link + '</td>'
-        top_signatures_html += '</tr>'
+# stream one of the two side-by-side port tables
+def iter_port_table_html(table_id, top_ports):
 
-    top_signatures_html += '</table>'
-    return top_signatures_html
+    yield ('<table class="psadTable" id="' + table_id + '">'
+           '<tr class="psadTableRow">'
+           '<td class="psadTableHead">Port</td>'
+           '<td class="psadTableHead">Hits</td>'
+           '</tr>')
 
-def get_ports_html(top_ports):
+    for port in top_ports:
+
+        count('records')
+        yield ''.join((
+            '<tr class="psadTableRow">',
+            '<td class="psadTableCell"><a href="https://www.speedguide.net/port.php?port=', port.port_num,
+            '" target="_blank">', port.port_num, '</a></td>',
+            '<td class="psadTableCell">', str(port.hits), '</td>',
+            '</tr>'
+        ))
+
+    yield '</table>'
+
+# stream the top ports HTML tables
+def iter_ports_html(top_ports):
 
     rows = 50 if len(top_ports) > 50 else len(top_ports)
 
-    top_ports_html = '<div id="portTableDiv">'
-    top_ports_html += '<table class="psadTable" id="portTable01">'
-    top_ports_html += '<tr class="psadTableRow">'
-    top_ports_html += '<td class="psadTableHead">Port</td>'
-    top_ports_html += '<td class="psadTableHead">Hits</td>'
-    top_ports_html += '</tr>'
+    yield '<div id="portTableDiv">'
+    for chunk in iter_port_table_html('portTable01', top_ports[:rows//2]):
+        yield chunk
+    for chunk in iter_port_table_html('portTable02', top_ports[rows//2:rows]):
+        yield chunk
+    yield '</div>'
+
+# stream the per-sensor breakdown HTML table
+def iter_sensors_html(sensors):
+
+    yield ('<table class="psadTable" id="sensorTable">'
+           '<tr class="psadTableRow">'
+           '<td class="psadTableHead">Sensor</td>'
+           '<td class="psadTableHead">Attackers</td>'
+           '<td class="psadTableHead">Hits</td>'
+           '<td class="psadTableHead">Top Attacker</td>'
+           '<td class="psadTableHead">Top Signature</td>'
+           '<td class="psadTableHead">Top Port</td>'
+           '<td class="psadTableHead">Last Attack</td>'
+           '</tr>')
+
+    for sensor in sensors:
+
+        count('records')
+        yield ''.join((
+            '<tr class="psadTableRow">',
+            '<td class="psadTableCellLeft">', sensor['sensor'], '</td>',
+            '<td class="psadTableCell">', str(sensor['attackers']), '</td>',
+            '<td class="psadTableCell">', str(sensor['hits']), '</td>',
+            '<td class="psadTableCell">', sensor['top_attacker'], '</td>',
+            '<td class="psadTableCellLeft">', sensor['top_signature'], '</td>',
+            '<td class="psadTableCell">', sensor['top_port'], '</td>',
+            '<td class="psadTableCell">', sensor['last_attack'], '</td>',
+            '</tr>'
+        ))
+
+    yield '</table>'
+
+# the functions that show each tab of the page, in the order their
+# scripts come in
+TAB_FUNCTIONS = ('showLastAttacksTable', 'showAttackerTable', 'showSignatureTable', 'showPortsTable', 'showSensorTable', 'showTrendTable', 'showHeatmapTable')
+
+# an extra tab shown by the function name, wrapped around the tab
+# functions before it so they hide its table again
+def get_tab_javascript(name, table, button, display='table'):
+
+    js = """
+
+%s.forEach(function(name) {
+    var show = window[name];
+    if (!show) {
+        return;
+    }
+    window[name] = function() {
+        show();
+        document.getElementById("%s").style.display = "none";
+        document.getElementById("%s").style.fontWeight = "normal";
+    };
+});
+function %s() {
+    showLastAttacksTable();
+    document.getElementById("lastAttacksTable").style.display = "none";
+    document.getElementById("lastAttacksButton").style.fontWeight = "normal";
+    document.getElementById("%s").style.display = "%s";
+    document.getElementById("%s").style.fontWeight = "bold";
+}
+
+""" % (json.dumps(TAB_FUNCTIONS[:TAB_FUNCTIONS.index(name)]), table, button, name, table, display, button)
+    return js
+
+# stream the top movers HTML table
+def iter_trends_html(trends):
+
+    yield ('<table class="psadTable" id="trendTable">'
+           '<tr class="psadTableRow">'
+           '<td class="psadTableHead">Type</td>'
+           '<td class="psadTableHead">Attacker / Signature / Port</td>'
+           '<td class="psadTableHead">Hits (24h)</td>'
+           '<td class="psadTableHead">Previous 24h</td>'
+           '<td class="psadTableHead">Change</td>'
+           '</tr>')
+
+    for trend in trends:
+
+        count('records')
+        yield ''.join((
+            '<tr class="psadTableRow">',
+            '<td class="psadTableCell">', trend['kind'].capitalize(), '</td>',
+            '<td class="psadTableCellLeft">', trend['name'], '</td>',
+            '<td class="psadTableCell">', str(trend['hits']), '</td>',
+            '<td class="psadTableCell">', str(trend['previous']), '</td>',
+            '<td class="psadTableCell">', '%+d' % trend['change'], '</td>',
+            '</tr>'
+        ))
+
+    yield '</table>'
+
+# draws the heatmap records into a container: a grid of port buckets
+# shaded by how many attackers hit them, and the most targeted ports
+def get_heatmap_javascript():
+
+    js = """
+
+function fillHeatmap(id, records) {
+    var container = document.getElementById(id);
+    container.textContent = "";
+    records.forEach(function(record) {
+        var title = document.createElement("div");
+        title.className = "headerBlock";
+        title.textContent = record.protocol.toUpperCase() + ": " + record.attackers + " attackers, " + record.ports + " distinct ports";
+        container.appendChild(title);
+
+        var side = Math.ceil(Math.sqrt(record.buckets.length));
+        var cell = Math.floor(512 / side);
+        var width = 65536 / record.buckets.length;
+        var most = Math.max.apply(null, record.buckets.concat([1]));
+        var canvas = document.createElement("canvas");
+        canvas.width = canvas.height = side * cell;
+        canvas.style.display = "block";
+        canvas.style.margin = "0px auto 20px auto";
+        var context = canvas.getContext("2d");
+        record.buckets.forEach(function(attackers, i) {
+            var shade = attackers ? 0.2 + 0.8 * Math.log(attackers + 1) / Math.log(most + 1) : 0;
+            context.fillStyle = attackers ? "rgba(85, 255, 51, " + shade + ")" : "#111111";
+            context.fillRect((i % side) * cell, Math.floor(i / side) * cell, cell - 1, cell - 1);
+        });
+        canvas.onmousemove = function(event) {
+            var box = canvas.getBoundingClientRect();
+            var i = Math.floor((event.clientY - box.top) / cell) * side + Math.floor((event.clientX - box.left) / cell);
+            if (i >= 0 && i < record.buckets.length) {
+                canvas.title = "Ports " + i * width + "-" + ((i + 1) * width - 1) + ": up to " + record.buckets[i] + " attackers";
+            }
+        };
+        container.appendChild(canvas);
+
+        var table = document.createElement("table");
+        table.className = "psadTable";
+        table.style.display = "table";
+        table.style.margin = "0px auto 40px auto";
+        var head = table.insertRow();
+        head.className = "psadTableRow";
+        ["Port", "Attackers"].forEach(function(text) {
+            var td = head.insertCell();
+            td.className = "psadTableHead";
+            td.textContent = text;
+        });
+        record.top.forEach(function(port) {
+            var row = table.insertRow();
+            row.className = "psadTableRow";
+            port.forEach(function(value) {
+                var td = row.insertCell();
+                td.className = "psadTableCell";
+                td.textContent = String(value);
+            });
+        });
+        container.appendChild(table);
+    });
+}
+
+"""
+    return js
+
+# stream the heatmap tab, drawn in the browser from the compact records
+def iter_heatmap_html(heatmap):
+
+    yield '<div class="psadTable" id="heatmapTable" style="border: none; max-width: none;"></div>'
+    yield '<script>fillHeatmap("heatmapTable", ' + json.dumps(heatmap, separators=(',', ':')) + ');</script>'
+
+# stream rows as a script assigning a JSON array of arrays to name
+def iter_virtual_rows(name, rows):
+
+    yield '<script>var ' + name + ' = ['
+    separator = ''
+    for row in rows:
+        count('records')
+        yield separator + json.dumps(row, separators=(',', ':')).replace('</', '<\\/')
+        separator = ','
+    yield '];</script>'
+
+# stream every top attacker as compact rows for a virtual table; the links
+# are built in the browser from the IP
+def iter_virtual_attackers_html(top_attackers, pages_url=None):
+
+    top_attackers = sorted(top_attackers, key=lambda attacker: attacker.hits, reverse=True)
+
+    yield '<div class="psadTable virtualBlock" id="attackerTable"></div>'
+    rows = ([attacker.last_seen, attacker.hits, attacker.IP, attacker.country.upper(), attacker.host.strip()] for attacker in top_attackers)
+    for chunk in iter_virtual_rows('ATTACKER_ROWS', rows):
+        yield chunk
+    yield '<script>showVirtualAttackers(' + json.dumps(pages_url) + ');</script>'
 
-    for port in top_ports[:rows//2]:
+# stream every top port as compact rows for a virtual table
+def iter_virtual_ports_html(top_ports):
 
-        port_link = '<a href="https://www.speedguide.net/port.php?port=' + port['port_num']
-        port_link += '" target="_blank">' + port['port_num'] + '</a>'
+    yield '<div id="portTableDiv"><div class="psadTable virtualBlock" id="portTable01"></div><div id="portTable02"></div></div>'
+    rows = ([int(port.port_num) if port.port_num.isdigit() else port.port_num, port.hits] for port in top_ports)
+    for chunk in iter_virtual_rows('PORT_ROWS', rows):
+        yield chunk
+    yield '<script>showVirtualPorts();</script>'
 
-        top_ports_html += '<tr class="psadTableRow">'
-        top_ports_html += '<td class="psadTableCell">' + port_link + '</td>'
-        top_ports_html += '<td class="psadTableCell">' + port['hits'] + '</td>'
-        top_ports_html += '</tr>'
+def get_virtual_css():
 
-    top_ports_html += '</table>'
-    top_ports_html += '<table class="psadTable" id="portTable02">'
-    top_ports_html += '<tr class="psadTableRow">'
-    top_ports_html += '<td class="psadTableHead">Port</td>'
-    top_ports_html += '<td class="psadTableHead">Hits</td>'
-    top_ports_html += '</tr>'
+    css = """
+
+.virtualBlock {
+    border: none;
+}
+.virtualScroller {
+    max-height: 70vh;
+    overflow-y: auto;
+}
+.virtualTable {
+    border-collapse: collapse;
+    table-layout: fixed;
+    width: 100%;
+}
+.virtualTable th {
+    background-color: #000000;
+    cursor: pointer;
+    position: sticky;
+    top: 0;
+}
+.virtualTable td, .virtualTable th {
+    border: 1px solid #666666;
+    overflow: hidden;
+    padding: 5px 15px;
+    text-overflow: ellipsis;
+    white-space: nowrap;
+}
 
-    for port in top_ports[rows//2:rows]:
+"""
+    return css
 
-        port_link = '<a href="https://www.speedguide.net/port.php?port=' + port['port_num']
-        port_link += '" target="_blank">' + port['port_num'] + '</a>'
+# a table that only puts the rows in view into the DOM, sortable by
+# clicking a column head
+def get_virtual_javascript():
 
-        top_ports_html += '<tr class="psadTableRow">'
-        top_ports_html += '<td class="psadTableCell">' + port_link + '</td>'
-        top_ports_html += '<td class="psadTableCell">' + port['hits'] + '</td>'
-        top_ports_html += '</tr>'
+    js = """
 
-    top_ports_html += '</table>'
-    top_ports_html += '</div>'
+""" + get_osint_javascript() + """
+var MONTHS = "JanFebMarAprMayJunJulAugSepOctNovDec";
+
+function ctimeKey(text) {
+    var parts = String(text).split(/\\s+/);
+    if (parts.length < 5) {
+        return -1;
+    }
+    var time = parts[3].split(":");
+    return ((((Number(parts[4]) * 12 + MONTHS.indexOf(parts[1]) / 3) * 31 + Number(parts[2])) * 24 + Number(time[0])) * 60 + Number(time[1])) * 60 + Number(time[2]);
+}
+function virtualLink(href, text) {
+    var a = document.createElement("a");
+    a.href = href;
+    a.target = "_blank";
+    a.textContent = text;
+    return a;
+}
+function virtualOsint(ip) {
+    var span = document.createElement("span");
+    OSINT_SITES.forEach(function(site, i) {
+        span.appendChild(document.createTextNode(i ? "\\u00a0[" : "["));
+        span.appendChild(virtualLink(site + ip, String(i + 1)));
+        span.appendChild(document.createTextNode("]"));
+    });
+    return span;
+}
+function virtualTable(id, columns, rows) {
+    var scroller = document.createElement("div");
+    var table = document.createElement("table");
+    var head = document.createElement("tr");
+    var body = document.createElement("tbody");
+    var order = rows.map(function(row, i) {
+        return i;
+    });
+    var rowHeight = 30;
+    var sorted = null;
+    var pending = false;
+
+    scroller.className = "virtualScroller";
+    table.className = "virtualTable";
+    columns.forEach(function(column, c) {
+        var th = document.createElement("th");
+        th.className = "psadTableHead";
+        th.textContent = column.head;
+        th.style.width = column.width;
+        th.onclick = function() {
+            var descending = sorted !== c;
+            var sign = descending ? -1 : 1;
+            var key = column.key || function(row) {
+                return row[c];
+            };
+            var keys = rows.map(key);
+            order.sort(function(a, b) {
+                return keys[a] < keys[b] ? -sign : keys[a] > keys[b] ? sign : a - b;
+            });
+            sorted = descending ? c : null;
+            scroller.scrollTop = 0;
+            render();
+        };
+        head.appendChild(th);
+    });
+    var thead = document.createElement("thead");
+    thead.appendChild(head);
+    table.appendChild(thead);
+    table.appendChild(body);
+    scroller.appendChild(table);
+    document.getElementById(id).appendChild(scroller);
+
+    function spacer(height) {
+        var tr = document.createElement("tr");
+        tr.style.height = height + "px";
+        return tr;
+    }
+    function render() {
+        pending = false;
+        var visible = Math.ceil((scroller.clientHeight || window.innerHeight) / rowHeight);
+        var first = Math.max(0, Math.floor(scroller.scrollTop / rowHeight) - visible);
+        var last = Math.min(order.length, first + visible * 3);
+        var fragment = document.createDocumentFragment();
+        fragment.appendChild(spacer(first * rowHeight));
+        for (var i = first; i < last; i++) {
+            var row = rows[order[i]];
+            var tr = document.createElement("tr");
+            tr.className = "psadTableRow";
+            columns.forEach(function(column, c) {
+                var td = document.createElement("td");
+                var content = column.cell ? column.cell(row) : String(row[c]);
+                td.className = column.className || "psadTableCell";
+                if (typeof content === "string") {
+                    td.textContent = content;
+                    td.title = content;
+                } else {
+                    td.appendChild(content);
+                }
+                tr.appendChild(td);
+            });
+            fragment.appendChild(tr);
+        }
+        fragment.appendChild(spacer((order.length - last) * rowHeight));
+        body.textContent = "";
+        body.appendChild(fragment);
+        // rows are as tall as the browser draws them, so measure once shown
+        if (last > first && body.childNodes[1].offsetHeight && body.childNodes[1].offsetHeight !== rowHeight) {
+            rowHeight = body.childNodes[1].offsetHeight;
+            render();
+        }
+    }
+    scroller.onscroll = function() {
+        if (!pending) {
+            pending = true;
+            window.requestAnimationFrame(render);
+        }
+    };
+    table.render = render;
+    render();
+    return table;
+}
+function showVirtualAttackers(pagesUrl) {
+    var ipUrl = function(ip) {
+        return pagesUrl === null ? "https://www.whois.com/whois/" + ip : pagesUrl + ip.replace(/:/g, "_") + ".html";
+    };
+    var table = virtualTable("attackerTable", [
+        {head: "Last Seen", width: "17%", key: function(row) { return ctimeKey(row[0]); }},
+        {head: "Hits", width: "8%"},
+        {head: "IP Address", width: "15%", cell: function(row) { return virtualLink(ipUrl(row[2]), row[2]); }},
+        {head: "Country", width: "8%"},
+        {head: "Hosting Provider", width: "38%", className: "psadTableCellLeft"},
+        {head: "OSINT Links", width: "14%", cell: function(row) { return virtualOsint(row[2]); }}
+    ], ATTACKER_ROWS);
+    var show = window.showAttackerTable;
+    window.showAttackerTable = function() {
+        show();
+        table.render();
+    };
+}
+function showVirtualPorts() {
+    var table = virtualTable("portTable01", [
+        {head: "Port", width: "50%", cell: function(row) { return virtualLink("https://www.speedguide.net/port.php?port=" + row[0], String(row[0])); }},
+        {head: "Hits", width: "50%"}
+    ], PORT_ROWS);
+    var show = window.showPortsTable;
+    window.showPortsTable = function() {
+        show();
+        table.render();
+    };
+}
 
-    return top_ports_html
+"""
+    return js
 
 def get_css():
 
@@ -360,7 +1718,7 @@ body {
     font-family: Helvetica, Arial, Sans-Serif;
     font-size: small;
 }
-#lastAttacksTable, #attackerTable, #signatureTable {
+#lastAttacksTable, #attackerTable, #signatureTable, #sensorTable, #trendTable {
     margin: 0px auto 40px auto;
 }
 #portTable01, #portTable02 {
@@ -464,9 +1822,8 @@ window.onload = function() {
 """
     return js
 
-def get_html_header():
+def get_html_header(conf_file=PSAD_CONF_FILE, sensors=False, trends=False, heatmap=False):
 
-    conf_file = "/etc/psad/psad.conf"
     uptime = time.ctime(os.path.getmtime(conf_file))
 
     article_link = '<a href="https://disloops.com/psad-on-raspberry-pi" target="_blank">PSAD on Raspberry Pi</a>'
@@ -496,6 +1853,21 @@ def get_html_header():
     html += '<span id="topPortsButton">'
     html += '<a onclick="showPortsTable();" href="#">Top Ports</a>'
     html += '</span>'
+    if sensors:
+        html += '&nbsp;&nbsp;|&nbsp;&nbsp;'
+        html += '<span id="sensorsButton">'
+        html += '<a onclick="showSensorTable();" href="#">Sensors</a>'
+        html += '</span>'
+    if trends:
+        html += '&nbsp;&nbsp;|&nbsp;&nbsp;'
+        html += '<span id="trendsButton">'
+        html += '<a onclick="showTrendTable();" href="#">Trends</a>'
+        html += '</span>'
+    if heatmap:
+        html += '&nbsp;&nbsp;|&nbsp;&nbsp;'
+        html += '<span id="heatmapButton">'
+        html += '<a onclick="showHeatmapTable();" href="#">Port Heatmap</a>'
+        html += '</span>'
     html += '</div>'
 
     return html
@@ -511,26 +1883,1474 @@ def get_html_footer():
 
     return html
 
-def get_html(last_attacks, top_attackers, top_signatures, top_ports):
+# stream the whole page in the order it is written out
+def iter_html(last_attacks, top_attackers, top_signatures, top_ports, attackers_limit=TOP_ATTACKERS, conf_file=PSAD_CONF_FILE, sensors=None, trends=None, pages_url=None, virtual=False, heatmap=None):
+
+    yield ('<!DOCTYPE html><html><head><meta charset="UTF-8">'
+           '<meta http-equiv="refresh" content="120">'
+           '<title>Port Scan Attack Detector (PSAD) Status</title>')
+    yield '<style type="text/css">' + get_css() + '</style>'
+    yield '<script>' + get_javascript() + '</script>'
+    if virtual:
+        yield '<style type="text/css">' + get_virtual_css() + '</style>'
+        yield '<script>' + get_virtual_javascript() + '</script>'
+    if sensors:
+        yield '<script>' + get_tab_javascript('showSensorTable', 'sensorTable', 'sensorsButton') + '</script>'
+    if trends is not None:
+        yield '<script>' + get_tab_javascript('showTrendTable', 'trendTable', 'trendsButton') + '</script>'
+    if heatmap is not None:
+        yield '<script>' + get_heatmap_javascript() + get_tab_javascript('showHeatmapTable', 'heatmapTable', 'heatmapButton', 'block') + '</script>'
+    yield '</head><body>'
+    yield get_html_header(conf_file, bool(sensors), trends is not None, heatmap is not None)
+
+    if virtual:
+        attackers_html = iter_virtual_attackers_html(top_attackers, pages_url)
+        ports_html = iter_virtual_ports_html(top_ports)
+    else:
+        attackers_html = iter_attackers_html(top_attackers, attackers_limit, pages_url)
+        ports_html = iter_ports_html(top_ports)
+
+    tables = (
+        ('last_attacks_html', iter_last_attacks_html(last_attacks, pages_url)),
+        ('attackers_html', attackers_html),
+        ('signatures_html', iter_signatures_html(top_signatures)),
+        ('ports_html', ports_html)
+    )
+    if sensors:
+        tables += (('sensors_html', iter_sensors_html(sensors)),)
+    if trends is not None:
+        tables += (('trends_html', iter_trends_html(trends)),)
+    if heatmap is not None:
+        tables += (('heatmap_html', iter_heatmap_html(heatmap)),)
+    for name, table in tables:
+        for chunk in iter_stage(name, table):
+            yield chunk
+
+    yield get_html_footer()
+    yield '</body></html>'
+
+# text chunks are written as UTF-8, byte strings as they are
+def to_bytes(chunk):
+
+    if isinstance(chunk, bytes):
+        return chunk
+    return chunk.encode('utf-8')
+
+# SHA-256 of a file's contents, or None if it is missing
+def get_file_digest(file):
+
+    digest = hashlib.sha256()
+    try:
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                digest.update(block)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+# write chunks to a temp file next to the output and rename it into place,
+# so the web server never serves a partially written page; when the new
+# content matches the old the file and its mtime are left alone
+def write_atomic(output_file, chunks):
+
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    fd, tmp_file = tempfile.mkstemp(prefix='.' + os.path.basename(output_file), dir=output_dir)
+    digest = hashlib.sha256()
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                chunk = to_bytes(chunk)
+                digest.update(chunk)
+                f.write(chunk)
+
+        if digest.hexdigest() == get_file_digest(output_file):
+            os.remove(tmp_file)
+            return False
+
+        # mkstemp creates the file owner-only; keep the old page's mode
+        try:
+            mode = os.stat(output_file).st_mode & 0o777
+        except OSError:
+            mode = 0o644
+        os.chmod(tmp_file, mode)
+
+        os.rename(tmp_file, output_file)
+        return True
+    except:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+# gzip a page reproducibly so unchanged content gives an unchanged file
+def gzip_bytes(data):
+
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+# write .gz (and .br when brotli is installed) next to the output so the
+# web server can serve them as-is instead of compressing on every request
+def write_compressed(output_file, changed=True):
+
+    compressors = [('.gz', gzip_bytes)]
+    if brotli is not None:
+        compressors.append(('.br', lambda data: brotli.compress(data, quality=11)))
+
+    data = None
+    for suffix, compress in compressors:
+        if changed or not os.path.exists(output_file + suffix):
+            if data is None:
+                with open(output_file, 'rb') as f:
+                    data = f.read()
+            write_atomic(output_file + suffix, [compress(data)])
+
+            # keep the variants' Last-Modified in step with the page
+            stat = os.stat(output_file)
+            os.utime(output_file + suffix, (stat.st_atime, stat.st_mtime))
+
+# the data files written by --data-dir, one per section
+DATA_SECTIONS = ('last_attacks', 'top_attackers', 'top_signatures', 'top_ports')
+
+# one record as compact JSON with stable key order; record types are
+# written as objects like the dict records
+def dump_record(record):
+
+    if hasattr(record, '_asdict'):
+        record = record._asdict()
+    return json.dumps(record, sort_keys=True, separators=(',', ':'))
+
+# stream one section's records as compact JSON
+def iter_data(records, data_format='json'):
+
+    if data_format == 'ndjson':
+        for record in records:
+            yield dump_record(record) + '\n'
+        return
+
+    separator = '['
+    for record in records:
+        yield separator + dump_record(record)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+def get_shell_javascript(data_format='json', pages_url=None):
+
+    js = """
+
+var DATA_FORMAT = "%s";
+var PAGES_URL = %s;
+%s
+var TABS = {
+    lastAttacks: {file: "last_attacks", button: "lastAttacksButton", tables: ["lastAttacksTable"]},
+    attackers: {file: "top_attackers", button: "showAttackersButton", tables: ["attackerTable"]},
+    signatures: {file: "top_signatures", button: "topSignaturesButton", tables: ["signatureTable"]},
+    ports: {file: "top_ports", button: "topPortsButton", tables: ["portTable01", "portTable02"]},
+    sensors: {file: "sensors", button: "sensorsButton", tables: ["sensorTable"]},
+    trends: {file: "trends", button: "trendsButton", tables: ["trendTable"]},
+    heatmap: {file: "heatmap", button: "heatmapButton", tables: ["heatmapTable"]}
+};
+var currentTab = null;
+
+function parseData(text) {
+    if (DATA_FORMAT !== "ndjson") {
+        return JSON.parse(text);
+    }
+    return text.split("\\n").filter(function(line) {
+        return line.length > 0;
+    }).map(function(line) {
+        return JSON.parse(line);
+    });
+}
+function link(href, text) {
+    var a = document.createElement("a");
+    a.href = href;
+    a.target = "_blank";
+    a.textContent = text;
+    return a;
+}
+function ipLink(ip) {
+    return link(PAGES_URL === null ? "https://www.whois.com/whois/" + ip : PAGES_URL + ip.replace(/:/g, "_") + ".html", ip);
+}
+function osintLinks(ip) {
+    var span = document.createElement("span");
+    OSINT_SITES.forEach(function(site, i) {
+        span.appendChild(document.createTextNode((i ? "\\u00a0[" : "[")));
+        span.appendChild(link(site + ip, String(i + 1)));
+        span.appendChild(document.createTextNode("]"));
+    });
+    return span;
+}
+function addCell(row, content, className) {
+    var td = document.createElement("td");
+    td.className = className || "psadTableCell";
+    if (typeof content === "string") {
+        td.textContent = content;
+    } else {
+        td.appendChild(content);
+    }
+    row.appendChild(td);
+}
+function fillTable(id, heads, records, addCells) {
+    var table = document.getElementById(id);
+    var body = document.createElement("tbody");
+    var head = document.createElement("tr");
+    head.className = "psadTableRow";
+    heads.forEach(function(text) {
+        addCell(head, text, "psadTableHead");
+    });
+    body.appendChild(head);
+    records.forEach(function(record) {
+        var row = document.createElement("tr");
+        row.className = "psadTableRow";
+        addCells(row, record);
+        body.appendChild(row);
+    });
+    table.innerHTML = "";
+    table.appendChild(body);
+}
+function addPortCells(row, port) {
+    addCell(row, link("https://www.speedguide.net/port.php?port=" + port.port_num, port.port_num));
+    addCell(row, String(port.hits));
+}
+var RENDERERS = {
+    lastAttacks: function(records) {
+        fillTable("lastAttacksTable", ["Last Seen", "First Seen", "IP Address", "Country", "Ports Targeted", "OSINT Links"], records, function(row, attack) {
+            addCell(row, attack.last_seen);
+            addCell(row, attack.first_seen);
+            addCell(row, ipLink(attack.IP));
+            addCell(row, attack.country);
+            addCell(row, attack.ports);
+            addCell(row, osintLinks(attack.IP));
+        });
+    },
+    attackers: function(records) {
+        fillTable("attackerTable", ["Last Seen", "Hits", "IP Address", "Country", "Hosting Provider", "OSINT Links"], records, function(row, attacker) {
+            addCell(row, attacker.last_seen);
+            addCell(row, String(attacker.hits));
+            addCell(row, ipLink(attacker.IP));
+            addCell(row, attacker.country.toUpperCase());
+            addCell(row, attacker.host, "psadTableCellLeft");
+            addCell(row, osintLinks(attacker.IP));
+        });
+    },
+    signatures: function(records) {
+        fillTable("signatureTable", ["Hits", "SID", "Signature"], records, function(row, signature) {
+            addCell(row, String(signature.hits));
+            addCell(row, signature.SID);
+            addCell(row, link("https://www.google.com/search?q=" + encodeURIComponent(signature.sig).replace(/%%20/g, "+"), signature.sig), "psadTableCellLeft");
+        });
+    },
+    ports: function(records) {
+        var rows = Math.min(records.length, 50);
+        var half = Math.floor(rows / 2);
+        fillTable("portTable01", ["Port", "Hits"], records.slice(0, half), addPortCells);
+        fillTable("portTable02", ["Port", "Hits"], records.slice(half, rows), addPortCells);
+    },
+    sensors: function(records) {
+        fillTable("sensorTable", ["Sensor", "Attackers", "Hits", "Top Attacker", "Top Signature", "Top Port", "Last Attack"], records, function(row, sensor) {
+            addCell(row, sensor.sensor, "psadTableCellLeft");
+            addCell(row, String(sensor.attackers));
+            addCell(row, String(sensor.hits));
+            addCell(row, sensor.top_attacker);
+            addCell(row, sensor.top_signature, "psadTableCellLeft");
+            addCell(row, sensor.top_port);
+            addCell(row, sensor.last_attack);
+        });
+    },
+    trends: function(records) {
+        fillTable("trendTable", ["Type", "Attacker / Signature / Port", "Hits (24h)", "Previous 24h", "Change"], records, function(row, trend) {
+            addCell(row, trend.kind.charAt(0).toUpperCase() + trend.kind.slice(1));
+            addCell(row, trend.name, "psadTableCellLeft");
+            addCell(row, String(trend.hits));
+            addCell(row, String(trend.previous));
+            addCell(row, (trend.change > 0 ? "+" : "") + trend.change);
+        });
+    },
+    heatmap: function(records) {
+        fillHeatmap("heatmapTable", records);
+    }
+};
+function loadTab(name) {
+    var request = new XMLHttpRequest();
+    request.open("GET", TABS[name].file + "." + DATA_FORMAT);
+    request.setRequestHeader("Cache-Control", "no-cache");
+    request.onload = function() {
+        if (request.status === 200) {
+            RENDERERS[name](parseData(request.responseText));
+        }
+    };
+    request.send();
+}
+function showTab(name) {
+    currentTab = name;
+    loadTab(name);
+    Object.keys(TABS).forEach(function(tab) {
+        if (!document.getElementById(TABS[tab].button)) {
+            return;
+        }
+        TABS[tab].tables.forEach(function(id) {
+            document.getElementById(id).style.display = tab === name ? "table" : "none";
+        });
+        document.getElementById(TABS[tab].button).style.fontWeight = tab === name ? "bold" : "normal";
+    });
+}
+function showLastAttacksTable() {
+    showTab("lastAttacks");
+}
+function showAttackerTable() {
+    showTab("attackers");
+}
+function showSignatureTable() {
+    showTab("signatures");
+}
+function showPortsTable() {
+    showTab("ports");
+}
+function showSensorTable() {
+    showTab("sensors");
+}
+function showTrendTable() {
+    showTab("trends");
+}
+function showHeatmapTable() {
+    showTab("heatmap");
+}
+window.onload = function() {
+    showLastAttacksTable();
+    setInterval(function() {
+        loadTab(currentTab);
+    }, 120000);
+};
+
+""" % (data_format, json.dumps(pages_url), get_osint_javascript())
+    return js
+
+# the static page for --data-dir that fetches only the visible tab's data
+def get_shell_html(conf_file=PSAD_CONF_FILE, data_format='json', sensors=False, trends=False, pages_url=None, heatmap=False):
 
     html = '<!DOCTYPE html><html><head><meta charset="UTF-8">'
-    html += '<meta http-equiv="refresh" content="120">'
     html += '<title>Port Scan Attack Detector (PSAD) Status</title>'
     html += '<style type="text/css">' + get_css() + '</style>'
-    html += '<script>' + get_javascript() + '</script>'
+    html += '<script>' + get_shell_javascript(data_format, pages_url) + '</script>'
+    if heatmap:
+        html += '<script>' + get_heatmap_javascript() + '</script>'
     html += '</head><body>'
-    html += get_html_header()
-    html += get_last_attacks_html(last_attacks)
-    html += get_attackers_html(top_attackers)
-    html += get_signatures_html(top_signatures)
-    html += get_ports_html(top_ports)
+    html += get_html_header(conf_file, sensors, trends, heatmap)
+    html += '<table class="psadTable" id="lastAttacksTable"></table>'
+    html += '<table class="psadTable" id="attackerTable"></table>'
+    html += '<table class="psadTable" id="signatureTable"></table>'
+    html += '<div id="portTableDiv">'
+    html += '<table class="psadTable" id="portTable01"></table>'
+    html += '<table class="psadTable" id="portTable02"></table>'
+    html += '</div>'
+    if sensors:
+        html += '<table class="psadTable" id="sensorTable"></table>'
+    if trends:
+        html += '<table class="psadTable" id="trendTable"></table>'
+    if heatmap:
+        html += '<div class="psadTable" id="heatmapTable" style="border: none; max-width: none;"></div>'
     html += get_html_footer()
     html += '</body></html>'
 
     return html
 
+# write each section as a data file plus the static shell page
+def write_data(data_dir, data, args):
+
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    sections = DATA_SECTIONS + (('sensors',) if data.get('sensors') else ()) + tuple(name for name in ('trends', 'heatmap') if name in data)
+    files = [(os.path.join(data_dir, name + '.' + args.data_format), iter_data(data[name], args.data_format)) for name in sections]
+    files.append((os.path.join(data_dir, 'index.html'), [get_shell_html(args.conf, args.data_format, bool(data.get('sensors')), 'trends' in data, get_pages_url(args.pages, data_dir), 'heatmap' in data)]))
+
+    written = 0
+    for file, chunks in files:
+        changed = write_atomic(file, chunks)
+        if args.compress:
+            write_compressed(file, changed)
+        written += changed
+
+    print(' [*] Wrote ' + str(written) + ' changed data file(s) to ' + data_dir)
+
+# the collectors and the psad input each one reads
+COLLECTORS = (
+    ('last_attacks', 'alerts'),
+    ('top_attackers', 'top_attackers'),
+    ('top_signatures', 'top_sigs'),
+    ('top_ports', 'top_ports')
+)
+
+# run one collector by name
+def run_collector(name, attackers=TOP_ATTACKERS, log_dir=PSAD_LOG_DIR):
+
+    with stage(name):
+        if name == 'last_attacks':
+            records = get_last_attacks(log_dir=log_dir)
+        elif name == 'top_attackers':
+            records = get_top_attackers(attackers, log_dir)
+        elif name == 'top_signatures':
+            records = get_top_signatures(log_dir)
+        elif name == 'top_ports':
+            records = get_top_ports(log_dir)
+        count('records', len(records))
+
+    return records
+
+# run the named collectors and return their results by name; with more
+# than one job they run side by side on their own threads
+def collect(names, attackers=TOP_ATTACKERS, log_dir=PSAD_LOG_DIR):
+
+    if _jobs < 2 or len(names) < 2:
+        return dict((name, run_collector(name, attackers, log_dir)) for name in names)
+
+    pool = ThreadPool(len(names))
+    try:
+        results = [(name, pool.apply_async(run_collector, (name, attackers, log_dir))) for name in names]
+        return dict((name, result.get()) for name, result in results)
+    finally:
+        pool.close()
+
+# a sensor is named after its log directory unless given as NAME=PATH;
+# rsync'd trees usually end in .../<host>/psad, so that suffix is skipped
+def parse_sensor(spec):
+
+    if '=' in spec:
+        name, log_dir = spec.split('=', 1)
+        return name, log_dir
+
+    path = os.path.normpath(os.path.abspath(spec))
+    name = os.path.basename(path)
+    if name == 'psad' and os.path.basename(os.path.dirname(path)):
+        name = os.path.basename(os.path.dirname(path))
+    return name, spec
+
+# a ctime() timestamp as seconds, for ordering attacks across sensors
+def parse_ctime(text):
+
+    try:
+        return time.mktime(time.strptime(text.strip()))
+    except (ValueError, OverflowError):
+        return 0
+
+# add up hits for the same key across sensors, highest total first
+def merge_hits(lists, key):
+
+    totals = {}
+    merged = []
+    for records in lists:
+        for record in records:
+            k = getattr(record, key)
+            if k not in totals:
+                totals[k] = [0, record]
+                merged.append(k)
+            totals[k][0] += record.hits
+
+    merged.sort(key=lambda k: totals[k][0], reverse=True)
+    return [totals[k][1]._replace(hits=totals[k][0]) for k in merged]
+
+# collect one sensor's share of the named collectors
+def collect_sensor(names, log_dir):
+
+    sensor_data = {}
+    for name in names:
+        with stage(name):
+            if name == 'last_attacks':
+                sensor_data[name] = get_last_attacks(log_dir=log_dir)
+            elif name == 'top_attackers':
+                sensor_data[name] = get_attacker_candidates(log_dir)
+            elif name == 'top_signatures':
+                sensor_data[name] = get_top_signatures(log_dir)
+            elif name == 'top_ports':
+                sensor_data[name] = get_top_ports(log_dir)
+
+    return sensor_data
+
+# the first record with the most hits, or None
+def get_top_record(records):
+
+    top = None
+    for record in records:
+        if top is None or record.hits > top.hits:
+            top = record
+    return top
+
+# summarize each sensor for the Sensors table
+def get_sensor_summary(sensors, sensor_data):
+
+    summary = []
+    for name, log_dir in sensors:
+        data = sensor_data[log_dir]
+        candidates = data['top_attackers']
+        top_attacker = max(candidates, key=lambda candidate: candidate[1]) if candidates else ('?', 0)
+
+        summary.append({
+            "sensor": name,
+            "attackers": len(candidates),
+            "hits": sum(hits for IP, hits in candidates),
+            "top_attacker": top_attacker[0],
+            "top_signature": getattr(get_top_record(data['top_signatures']), 'sig', '?'),
+            "top_port": getattr(get_top_record(data['top_ports']), 'port_num', '?'),
+            "last_attack": data['last_attacks'][0]['last_seen'] if data['last_attacks'] else '?'
+        })
+
+    return summary
+
+# collect the named sections from several log roots at once and merge them;
+# sensor_data keeps each root's raw results between watch regenerations
+def collect_sensors(names, attackers, sensors, sensor_data):
+
+    log_dirs = [log_dir for name, log_dir in sensors]
+
+    pool = ThreadPool(min(len(log_dirs), max(_jobs, 4)))
+    try:
+        results = [(log_dir, pool.apply_async(collect_sensor, (names, log_dir))) for log_dir in log_dirs]
+        for log_dir, result in results:
+            sensor_data.setdefault(log_dir, {}).update(result.get())
+    finally:
+        pool.close()
+
+    data = {}
+    for name in names:
+        with stage(name):
+            if name == 'last_attacks':
+                attacks = [attack for log_dir in log_dirs for attack in sensor_data[log_dir][name]]
+                attacks.sort(key=lambda attack: parse_ctime(attack['last_seen']), reverse=True)
+                data[name] = attacks[:20]
+            elif name == 'top_attackers':
+                # sum hits per IP and look each one up on the sensor that saw
+                # it most, so the enrichment stays at one lookup per row
+                totals = {}
+                order = []
+                for log_dir in log_dirs:
+                    for IP, hits in sensor_data[log_dir][name]:
+                        if IP not in totals:
+                            totals[IP] = [0, 0, log_dir]
+                            order.append(IP)
+                        totals[IP][0] += hits
+                        if hits > totals[IP][1]:
+                            totals[IP][1:] = [hits, log_dir]
+                data[name] = enrich_attackers([(IP, totals[IP][0], totals[IP][2]) for IP in order], attackers)
+                for log_dir in log_dirs:
+                    save_whois_cache(log_dir)
+            elif name == 'top_signatures':
+                data[name] = merge_hits([sensor_data[log_dir][name] for log_dir in log_dirs], 'SID')
+            elif name == 'top_ports':
+                data[name] = merge_hits([sensor_data[log_dir][name] for log_dir in log_dirs], 'port_num')
+            count('records', len(data[name]))
+
+    data['sensors'] = get_sensor_summary(sensors, sensor_data)
+    return data
+
+# how long each history resolution (in seconds) is kept before its
+# samples are rolled up into the next one; the last is kept for --retention
+HISTORY_RESOLUTIONS = ((60, 2 * 86400), (3600, 60 * 86400), (86400, None))
+HISTORY_RETENTION = 365
+TRENDS_LIMIT = 10
+
+# the collectors stored in the history, with the kind of series they feed
+HISTORY_KINDS = (
+    ('top_attackers', 'attacker'),
+    ('top_signatures', 'signature'),
+    ('top_ports', 'port')
+)
+
+# the history database and its retention in days, set up by open_history()
+_history = None
+_history_retention = HISTORY_RETENTION
+
+# open the history database, creating its tables on first use
+def open_history(file, retention=HISTORY_RETENTION):
+
+    global _history, _history_retention
+
+    if sqlite3 is None:
+        raise ValueError('the history needs the sqlite3 module')
+
+    directory = os.path.dirname(file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # series holds the last hits seen for each key, so a run only stores
+    # how much each one grew; samples are bucketed per resolution
+    try:
+        db = sqlite3.connect(file)
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS series (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                label TEXT,
+                hits INTEGER NOT NULL,
+                seen INTEGER NOT NULL,
+                UNIQUE (kind, key)
+            );
+            CREATE TABLE IF NOT EXISTS samples (
+                resolution INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                series INTEGER NOT NULL,
+                delta INTEGER NOT NULL,
+                PRIMARY KEY (resolution, ts, series)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+    except sqlite3.Error as e:
+        raise ValueError(str(e))
+
+    _history = db
+    _history_retention = retention
+
+# the (key, label, hits) totals of one collector, summed across sensors
+def get_history_totals(name, data, sensors):
+
+    totals = {}
+    labels = {}
+
+    if name == 'top_attackers':
+        # the report only keeps the attackers it shows, so use the full list
+        sensor_data = data.get('sensor_data', {})
+        for sensor, log_dir in sensors:
+            candidates = sensor_data.get(log_dir, {}).get(name)
+            if candidates is None:
+                candidates = _candidates.get(log_dir, [])
+            for IP, hits in candidates:
+                totals[IP] = totals.get(IP, 0) + hits
+    else:
+        for record in data[name]:
+            key = record[0]
+            totals[key] = totals.get(key, 0) + record.hits
+            if name == 'top_signatures':
+                labels[key] = record.sig
+
+    return [(key, labels.get(key), hits) for key, hits in totals.items()]
+
+# add deltas to the samples of one resolution, merging into existing buckets
+def add_samples(resolution, samples):
+
+    _history.executemany('INSERT OR IGNORE INTO samples VALUES (?, ?, ?, 0)', [(resolution, ts, series) for ts, series, delta in samples])
+    _history.executemany('UPDATE samples SET delta = delta + ? WHERE resolution = ? AND ts = ? AND series = ?', [(delta, resolution, ts, series) for ts, series, delta in samples])
+
+# store how much each attacker, signature and port grew since the last
+# run; psad's counters only go up, so a smaller total means it was reset.
+# Only the series whose hits changed are written; when they are seen is
+# refreshed for the rest once an hour, ahead of the rollup
+def record_history(data, names, sensors, now=None):
+
+    now = int(now or time.time())
+    resolution = HISTORY_RESOLUTIONS[0][0]
+    bucket = now - now % resolution
+    compact = is_compaction_due(now)
+
+    with _history:
+        # one pass over the table is much cheaper than an index lookup for
+        # each of its rows
+        series = dict((kind, {}) for name, kind in HISTORY_KINDS)
+        for kind, key, id, hits, label in _history.execute('SELECT kind, key, id, hits, label FROM series'):
+            series.setdefault(kind, {})[key] = (id, hits, label)
+
+        for name, kind in HISTORY_KINDS:
+            if name not in names:
+                continue
+
+            known = series[kind]
+            # the first run only sets the baseline, or every total would
+            # show up as a day's worth of hits
+            baseline = not known
+
+            samples = []
+            updates = []
+            seen = []
+            for key, label, hits in get_history_totals(name, data, sensors):
+                count('records')
+                if key not in known:
+                    cursor = _history.execute('INSERT INTO series (kind, key, label, hits, seen) VALUES (?, ?, ?, ?, ?)', (kind, key, label, hits, now))
+                    if hits and not baseline:
+                        samples.append((bucket, cursor.lastrowid, hits))
+                    continue
+
+                id, previous, previous_label = known[key]
+                if hits != previous or label not in (None, previous_label):
+                    delta = hits - previous if hits >= previous else hits
+                    if delta:
+                        samples.append((bucket, id, delta))
+                    updates.append((hits, label, now, id))
+                elif compact:
+                    seen.append((now, id))
+
+            _history.executemany('UPDATE series SET hits = ?, label = COALESCE(?, label), seen = ? WHERE id = ?', updates)
+            _history.executemany('UPDATE series SET seen = ? WHERE id = ?', seen)
+            add_samples(resolution, samples)
+
+        if compact:
+            compact_history(now)
+
+# whether the hourly rollup is due
+def is_compaction_due(now):
+
+    row = _history.execute("SELECT value FROM meta WHERE name = 'compacted'").fetchone()
+    return row is None or now - row[0] >= 3600
+
+# roll samples past their resolution's age into the next coarser one and
+# drop what is older than the retention
+def compact_history(now):
+
+    for (resolution, keep), (coarser, coarser_keep) in zip(HISTORY_RESOLUTIONS, HISTORY_RESOLUTIONS[1:]):
+        # only whole buckets of the coarser resolution are rolled up
+        cutoff = now - keep
+        cutoff -= cutoff % coarser
+        samples = _history.execute('SELECT ts - ts % ?, series, SUM(delta) FROM samples WHERE resolution = ? AND ts < ? GROUP BY 1, 2', (coarser, resolution, cutoff)).fetchall()
+        add_samples(coarser, samples)
+        _history.execute('DELETE FROM samples WHERE resolution = ? AND ts < ?', (resolution, cutoff))
+
+    cutoff = now - _history_retention * 86400
+    _history.execute('DELETE FROM samples WHERE resolution = ? AND ts < ?', (HISTORY_RESOLUTIONS[-1][0], cutoff))
+    _history.execute('DELETE FROM series WHERE seen < ? AND NOT EXISTS (SELECT 1 FROM samples WHERE samples.series = series.id)', (cutoff,))
+    _history.execute("INSERT OR REPLACE INTO meta VALUES ('compacted', ?)", (now,))
+
+# the attackers, signatures and ports whose hits grew the most over the
+# last day compared with the day before, limit of each
+def get_trends(limit=TRENDS_LIMIT, now=None, window=86400):
+
+    now = int(now or time.time())
+    since = now - window
+
+    # the finest resolution covers both days, so this reads a couple of
+    # days of samples however long the history is
+    resolutions = [resolution for resolution, keep in HISTORY_RESOLUTIONS]
+    rows = _history.execute('SELECT series.kind, series.key, series.label, '
+                            'SUM(CASE WHEN samples.ts >= ? THEN samples.delta ELSE 0 END), '
+                            'SUM(CASE WHEN samples.ts < ? THEN samples.delta ELSE 0 END) '
+                            'FROM samples JOIN series ON series.id = samples.series '
+                            'WHERE samples.resolution IN (' + ', '.join('?' * len(resolutions)) + ') AND samples.ts >= ? '
+                            'GROUP BY samples.series',
+                            [since, since] + resolutions + [since - window]).fetchall()
+
+    trends = []
+    for name, kind in HISTORY_KINDS:
+        movers = [row for row in rows if row[0] == kind and row[3] > 0]
+        for kind, key, label, hits, previous in heapq.nlargest(limit, movers, key=lambda row: (row[3] - row[4], row[3])):
+            trends.append({
+                "kind": kind,
+                "key": key,
+                "name": label or key,
+                "hits": hits,
+                "previous": previous,
+                "change": hits - previous
+            })
+
+    return trends
+
+# detail pages are written again only when these change for an IP
+PAGES_VERSION = 1
+
+# separator line between the alert emails psad appends to a file
+ALERT_SEPARATOR = '=-=-=-='
+alert_field_re = re.compile(r'^\s*([A-Za-z][\w /()-]*?):\s+(.*?)\s*$')
+alert_section_re = re.compile(r'^\s*\[\+\]\s*(.*?):?\s*$')
+
+# the file name of an IP's detail page; IPv6 colons are not URL friendly
+def get_page_name(IP):
+
+    return IP.replace(':', '_') + '.html'
+
+# the URL of the detail pages as seen from pages in from_dir, or None
+def get_pages_url(pages_dir, from_dir):
+
+    if not pages_dir:
+        return None
+    url = os.path.relpath(pages_dir, os.path.abspath(from_dir or '.')).replace(os.sep, '/')
+    return '' if url == '.' else url + '/'
+
+# read the newest alert email in a file as its fields and sections; psad
+# appends each alert to the end, so only the tail is read
+def parse_alert_details(file):
+
+    count('files_opened')
+    with open(file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - ALERT_READ_LIMIT))
+        text = f.read().decode('utf-8', 'replace')
+    count('bytes_read', len(text))
+
+    blocks = [block for block in re.split(r'(?m)^' + ALERT_SEPARATOR + '.*$', text) if block.strip()]
+    fields = []
+    sections = []
+    entries = None
+
+    # fields before the first [+] heading describe the scan; each section
+    # holds quoted entries (signatures) with their own fields, or plain text
+    for line in (blocks[-1] if blocks else '').splitlines():
+        section = alert_section_re.match(line)
+        field = alert_field_re.match(line)
+        if section:
+            entries = []
+            sections.append((section.group(1), entries, []))
+        elif entries is None:
+            if field:
+                fields.append((field.group(1), field.group(2)))
+            elif line.strip() and fields:
+                fields[-1] = (fields[-1][0], fields[-1][1] + '\n' + line.strip())
+        elif line.strip().startswith('"'):
+            entries.append([('Name', line.strip().strip('"'))])
+        elif field and entries:
+            entries[-1].append((field.group(1), field.group(2)))
+        elif line.strip():
+            sections[-1][2].append(line.rstrip())
+
+    return fields, sections
+
+# daily hits per attacker over the last days from the history database,
+# as {IP: [(day, hits)]}; a query covers a few hundred pages at a time
+def get_attackers_history(IPs, days=30):
+
+    history = dict((IP, []) for IP in IPs)
+    if _history is None:
+        return history
+
+    since = int(time.time()) - days * 86400
+    resolutions = [resolution for resolution, keep in HISTORY_RESOLUTIONS]
+    IPs = list(IPs)
+    for start in range(0, len(IPs), 500):
+        batch = IPs[start:start + 500]
+        ids = dict(_history.execute('SELECT id, key FROM series WHERE kind = ? AND key IN (' + ', '.join('?' * len(batch)) + ')', ['attacker'] + batch).fetchall())
+        if not ids:
+            continue
+        rows = _history.execute('SELECT series, ts - ts % 86400, SUM(delta) FROM samples '
+                                'WHERE resolution IN (' + ', '.join('?' * len(resolutions)) + ') AND ts >= ? '
+                                'AND series IN (' + ', '.join('?' * len(ids)) + ') GROUP BY 1, 2 ORDER BY 2',
+                                resolutions + [since] + list(ids))
+        for series, day, hits in rows:
+            history[ids[series]].append((day, hits))
+
+    return history
+
+# stream a two column table of names and values
+def iter_detail_table(rows, heads=('Field', 'Value')):
+
+    yield '<table class="psadTable"><tr class="psadTableRow">'
+    for head in heads:
+        yield '<td class="psadTableHead">' + escape(head) + '</td>'
+    yield '</tr>'
+    for row in rows:
+        count('records')
+        yield '<tr class="psadTableRow">' + ''.join('<td class="psadTableCellLeft">' + escape(str(value)) + '</td>' for value in row) + '</tr>'
+    yield '</table>'
+
+# stream the detail page of one IP from what each sensor has on it
+def iter_attacker_page(IP, details, history):
+
+    yield ('<!DOCTYPE html><html><head><meta charset="UTF-8">'
+           '<title>' + escape(IP) + ' - Port Scan Attack Detector (PSAD)</title>'
+           '<style type="text/css">' + get_css() + '.psadTable {display: table; margin: 0px auto 40px auto;}</style>'
+           '</head><body>')
+    yield ('<div class="headerBlock"><span style="font-weight: bold;">' + escape(IP) + '</span><br><br>'
+           '<a href="https://www.whois.com/whois/' + IP + '" target="_blank">WHOIS</a>&nbsp;&nbsp;' + get_osint_links(IP) + '</div>')
+
+    for sensor, alert, fields, sections, whois in details:
+        if len(details) > 1:
+            yield '<div class="headerBlock"><span style="font-weight: bold;">Sensor: ' + escape(sensor) + '</span></div>'
+
+        if alert:
+            yield '<div class="headerBlock">Latest alert, ' + escape(time.ctime(alert)) + '</div>'
+            for chunk in iter_detail_table(fields):
+                yield chunk
+        for title, entries, lines in sections:
+            yield '<div class="headerBlock">' + escape(title) + '</div>'
+            if entries:
+                heads = []
+                for entry in entries:
+                    heads.extend(name for name, value in entry if name not in heads)
+                rows = [[dict(entry).get(name, '') for name in heads] for entry in entries]
+                for chunk in iter_detail_table(rows, heads):
+                    yield chunk
+            if lines:
+                yield '<pre class="headerBlock" style="text-align: left;">' + escape('\n'.join(lines)) + '</pre>'
+        if whois:
+            yield '<div class="headerBlock">WHOIS</div>'
+            yield '<pre class="headerBlock" style="text-align: left;">' + escape(whois) + '</pre>'
+
+    if history:
+        yield '<div class="headerBlock">Hits per day</div>'
+        for chunk in iter_detail_table([(time.strftime('%Y-%m-%d', time.gmtime(day)), hits) for day, hits in history], ('Day', 'Hits')):
+            yield chunk
+
+    yield get_html_footer()
+    yield '</body></html>'
+
+# what a detail page is built from on one sensor: the alert file's name and
+# mtime and the WHOIS file's size and mtime
+def get_page_source(log_dir, IP, entry):
+
+    whois = None
+    try:
+        count('files_stated')
+        stat = os.stat(os.path.join(log_dir, IP, IP + '_whois'))
+        whois = [stat.st_size, stat.st_mtime]
+    except OSError:
+        pass
+    return [log_dir, entry[ALERT_NAME], entry[ALERT_MTIME], whois]
+
+# read what one sensor has on an IP for its detail page
+def get_page_details(sensor, IP, source):
+
+    log_dir, alert_name, alert_mtime, whois = source
+    fields, sections = [], []
+    whois_text = None
+
+    try:
+        if alert_name:
+            fields, sections = parse_alert_details(os.path.join(log_dir, IP, alert_name))
+        if whois:
+            count('files_opened')
+            with open(os.path.join(log_dir, IP, IP + '_whois'), 'r') as f:
+                whois_text = f.read()
+    except (IOError, OSError):
+        count('dropped')
+
+    return sensor, alert_mtime, fields, sections, whois_text
+
+# bring the per-IP detail pages in pages_dir up to date: write those whose
+# alert or WHOIS files changed since the manifest was saved and remove the
+# pages of IPs psad has expired
+def write_pages(pages_dir, sensors, compress=False):
+
+    name = get_state_name('pages', pages_dir)
+    manifest = load_state(name)
+    if not manifest or manifest.get('version') != PAGES_VERSION or not os.path.isdir(pages_dir):
+        manifest = {'version': PAGES_VERSION, 'ips': {}}
+        if not os.path.isdir(pages_dir):
+            os.makedirs(pages_dir)
+
+    sources = {}
+    names = {}
+    for sensor, log_dir in sensors:
+        catalog = get_catalog(log_dir)
+        items = [(IP, entry) for IP, entry in catalog['ips'].items() if is_reported_ip(IP)]
+        for (IP, entry), source in zip(items, parallel_map(lambda item: get_page_source(log_dir, item[0], item[1]), items)):
+            sources.setdefault(IP, []).append(source)
+            names[log_dir] = sensor
+
+    changed = [IP for IP in sources if manifest['ips'].get(IP) != sources[IP]]
+    history = get_attackers_history(changed)
+
+    def write_page(IP):
+        details = [get_page_details(names[source[0]], IP, source) for source in sources[IP]]
+        page = os.path.join(pages_dir, get_page_name(IP))
+        written = write_atomic(page, iter_attacker_page(IP, details, history[IP]))
+        if compress:
+            write_compressed(page, written)
+        return written
+
+    written = sum(parallel_map(write_page, changed))
+    for IP in changed:
+        manifest['ips'][IP] = sources[IP]
+
+    expired = [IP for IP in manifest['ips'] if IP not in sources]
+    for IP in expired:
+        page = os.path.join(pages_dir, get_page_name(IP))
+        for file in (page, page + '.gz', page + '.br'):
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+        del manifest['ips'][IP]
+
+    if changed or expired:
+        save_state(name, manifest)
+    print(' [*] Wrote ' + str(written) + ' detail page(s), removed ' + str(len(expired)) + ' in ' + pages_dir)
+
+# render the collected data and write it to the output file, as set up by
+# the command line options in args
+def write_report(output_file, data, args):
+
+    if args.pages:
+        with stage('pages'):
+            write_pages(args.pages, args.sensors, args.compress)
+
+    if args.data_dir:
+        with stage('data'):
+            write_data(args.data_dir, data, args)
+
+    if not output_file:
+        return
+
+    chunks = iter_html(data['last_attacks'], data['top_attackers'], data['top_signatures'], data['top_ports'], args.attackers, args.conf, data.get('sensors'), data.get('trends'), get_pages_url(args.pages, os.path.dirname(output_file)), args.virtual, data.get('heatmap'))
+    # the per-table stages nest inside this one
+    with stage('html'):
+        changed = write_atomic(output_file, chunks)
+    if changed:
+        print(' [*] Writing output to ' + output_file)
+    else:
+        print(' [*] Output unchanged, leaving ' + output_file + ' as is')
+
+    if args.compress:
+        with stage('compress'):
+            write_compressed(output_file, changed)
+
+# run the named collectors and write the report, returning the new data
+def regenerate(output_file, data, names, args):
+
+    if args.metrics:
+        start_metrics()
+    start = time.time()
+
+    data = dict(data)
+    if len(args.sensors) > 1:
+        data.update(collect_sensors(names, args.attackers, args.sensors, data.setdefault('sensor_data', {})))
+    else:
+        data.update(collect(names, args.attackers, args.sensors[0][1]))
+    # the port ranges come from the alert files, so they follow last_attacks
+    if args.heatmap and ('last_attacks' in names or 'heatmap' not in data):
+        with stage('heatmap'):
+            data['heatmap'] = get_port_heatmap(args.sensors)
+    if _history is not None:
+        with stage('history'):
+            record_history(data, names, args.sensors)
+            data['trends'] = get_trends()
+    write_report(output_file, data, args)
+
+    duration = time.time() - start
+    if args.metrics:
+        write_metrics(args.metrics, duration)
+    return data, duration
+
+# size and mtime of a file, or None if it is missing
+def get_file_state(file):
+
+    try:
+        stat = os.stat(file)
+        return stat.st_size, stat.st_mtime
+    except OSError:
+        return None
+
+# inotify flags from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# the events that add or expire IP directories in a log root, and the ones
+# that change the alert and WHOIS files in an IP directory
+ROOT_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+IP_DIR_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+# how often, in seconds, a log tree without inotify has its alert files
+# stat()ed at most while the top_* files keep changing
+CATALOG_INTERVAL = 60.0
+
+# the inotify watches on each log tree, or None where the tree is polled
+_alert_watches = {}
+
+# the last catalog refresh of each polled log tree and what prompted it
+_catalog_polls = {}
+
+# add an inotify watch on an IP directory; psad may have expired it since
+def add_ip_watch(watch, log_dir, ip):
+
+    wd = libc.inotify_add_watch(watch['fd'], to_bytes(os.path.join(log_dir, ip)), IP_DIR_EVENTS)
+    if wd < 0:
+        e = ctypes.get_errno()
+        if e not in (errno.ENOENT, errno.ENOTDIR):
+            raise OSError(e, os.strerror(e))
+        return
+    watch['dirs'][wd] = ip
+
+# watch a log root for IP directories and every IP directory for its
+# files, or None without inotify or when the tree needs more watches than
+# the kernel allows (fs.inotify.max_user_watches)
+def start_alert_watch(log_dir):
+
+    if libc is None:
+        return None
+
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+
+    # ips collects the IP directories with events until the catalog looks
+    # at them; synced says the catalog was refreshed in full since
+    watch = {'fd': fd, 'root': libc.inotify_add_watch(fd, to_bytes(log_dir), ROOT_EVENTS), 'dirs': {}, 'ips': set(), 'synced': False, 'generation': 0}
+    try:
+        if watch['root'] < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch')
+        count('dirs_listed')
+        for ip in os.listdir(log_dir):
+            if parse_ip(ip) is not None:
+                add_ip_watch(watch, log_dir, ip)
+    except OSError:
+        os.close(fd)
+        return None
+
+    return watch
+
+# drain the pending inotify events of a log tree into the IPs whose
+# directories they touched, returning whether there were any
+def read_alert_events(watch, log_dir):
+
+    changed = False
+    while True:
+        try:
+            events = os.read(watch['fd'], 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return changed
+            raise
+
+        offset = 0
+        while offset < len(events):
+            wd, mask, cookie, length = struct.unpack_from('iIII', events, offset)
+            name = events[offset + 16:offset + 16 + length].split(b'\0', 1)[0].decode('utf-8', 'replace')
+            offset += 16 + length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so the catalog needs a full refresh and
+                # whatever directory they announced needs a watch
+                changed = True
+                watch['synced'] = False
+                watched = set(watch['dirs'].values())
+                for ip in os.listdir(log_dir):
+                    if ip not in watched and parse_ip(ip) is not None:
+                        add_ip_watch(watch, log_dir, ip)
+            elif wd == watch['root']:
+                # the top_* files live in the root too, but are not alerts
+                if parse_ip(name) is not None:
+                    changed = True
+                    watch['ips'].add(name)
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        add_ip_watch(watch, log_dir, name)
+            elif mask & IN_IGNORED:
+                watch['dirs'].pop(wd, None)
+            elif wd in watch['dirs']:
+                changed = True
+                watch['ips'].add(watch['dirs'][wd])
+
+# a value that changes with the alert files of a log tree. Under inotify
+# it costs nothing until an event comes in; otherwise every alert file
+# is stat()ed, so that only happens when IP directories came or went, or
+# at most every CATALOG_INTERVAL while the top_* files keep changing
+def get_alerts_state(log_dir):
+
+    if log_dir not in _alert_watches:
+        _alert_watches[log_dir] = start_alert_watch(log_dir)
+
+    watch = _alert_watches[log_dir]
+    if watch is not None:
+        try:
+            if read_alert_events(watch, log_dir):
+                watch['generation'] += 1
+            return 'inotify', watch['generation']
+        except OSError:
+            # out of watches for a new directory, so poll from now on
+            os.close(watch['fd'])
+            _alert_watches[log_dir] = None
+
+    count('files_stated')
+    root_mtime = os.stat(log_dir).st_mtime
+    inputs = tuple(get_file_state(os.path.join(log_dir, name)) for name in ('top_attackers', 'top_sigs', 'top_ports'))
+
+    poll = _catalog_polls.get(log_dir)
+    if poll is None or poll['root_mtime'] != root_mtime or (poll['inputs'] != inputs and time.time() - poll['time'] >= CATALOG_INTERVAL):
+        poll = {'root_mtime': root_mtime, 'inputs': inputs, 'time': time.time(), 'generation': refresh_catalog(log_dir)['generation']}
+        _catalog_polls[log_dir] = poll
+    return 'catalog', poll['generation']
+
+# fingerprint the psad inputs so a watcher can tell what changed
+def get_input_state(log_dirs=(PSAD_LOG_DIR,), conf_file=PSAD_CONF_FILE):
+
+    state = {}
+    for name in ('top_attackers', 'top_sigs', 'top_ports'):
+        state[name] = tuple(get_file_state(os.path.join(log_dir, name)) for log_dir in log_dirs)
+    state['conf'] = get_file_state(conf_file)
+
+    state['alerts'] = []
+    for log_dir in log_dirs:
+        try:
+            state['alerts'].append(get_alerts_state(log_dir))
+        except OSError:
+            state['alerts'].append(None)
+
+    return state
+
+# regenerate the report whenever the psad inputs change
+def watch(output_file, args):
+
+    interval = args.watch
+    settle = args.settle
+
+    data = {}
+    state = {}
+
+    while True:
+        new_state = get_input_state([log_dir for name, log_dir in args.sensors], args.conf)
+        changed = set(key for key in new_state if new_state[key] != state.get(key))
+
+        # psad rewrites several files in a row, so wait for a quiet period
+        # before regenerating; the deadline keeps a busy sensor from starving us
+        if changed and state:
+            deadline = time.time() + max(interval, settle) * 5
+            while time.time() < deadline:
+                time.sleep(settle)
+                settled_state = get_input_state([log_dir for name, log_dir in args.sensors], args.conf)
+                if settled_state == new_state:
+                    break
+                changed.update(key for key in settled_state if settled_state[key] != new_state[key])
+                new_state = settled_state
+
+        if changed:
+            names = [name for name, input in COLLECTORS if input in changed or name not in data]
+            try:
+                data, duration = regenerate(output_file, data, names, args)
+            except Exception as e:
+                # keep the last good data and leave the state alone, so the
+                # next poll tries again rather than the watcher dying
+                print(' [!] Could not regenerate: ' + str(e))
+                sys.stdout.flush()
+                time.sleep(interval)
+                continue
+            print(' [*] Regenerated in %.2fs (changed: %s)' % (duration, ', '.join(sorted(changed))))
+            sys.stdout.flush()
+
+        state = new_state
+        time.sleep(interval)
+
+# how often --serve looks at the psad inputs when no -w interval is given
+SERVE_INTERVAL = 5.0
+
+# the page --serve answers with: its bytes, gzip copy, ETags and mtime,
+# plus the input state and data it was built from
+_served = {'page': None, 'state': None, 'data': {}, 'checked': 0}
+_serve_lock = threading.Lock()
+
+# the served page, built again when the psad inputs changed; a request
+# that comes in while another is rebuilding waits for that rebuild and
+# shares its result rather than parsing everything a second time
+def get_served_page(args, interval):
+
+    if _served['page'] is not None and time.time() - _served['checked'] < interval:
+        return _served['page']
+
+    with _serve_lock:
+        if _served['page'] is not None and time.time() - _served['checked'] < interval:
+            return _served['page']
+
+        try:
+            state = get_input_state([log_dir for name, log_dir in args.sensors], args.conf)
+            if state != _served['state']:
+                previous = _served['state'] or {}
+                changed = set(key for key in state if state[key] != previous.get(key))
+                names = [name for name, input in COLLECTORS if input in changed or name not in _served['data']]
+                data, duration = regenerate(args.output, _served['data'], names, args)
+
+                body = b''.join(to_bytes(chunk) for chunk in iter_html(data['last_attacks'], data['top_attackers'], data['top_signatures'], data['top_ports'],
+                                                                       args.attackers, args.conf, data.get('sensors'), data.get('trends'), None, args.virtual, data.get('heatmap')))
+                page = _served['page']
+                if page is None or page['body'] != body:
+                    etag = hashlib.sha256(body).hexdigest()[:32]
+                    page = {
+                        'body': body,
+                        'gzip': gzip_bytes(body),
+                        'etag': '"' + etag + '"',
+                        'gzip_etag': '"' + etag + '-gz"',
+                        'modified': int(time.time())
+                    }
+                _served.update(page=page, state=state, data=data)
+                print(' [*] Rebuilt in %.2fs (changed: %s)' % (duration, ', '.join(sorted(changed))))
+                sys.stdout.flush()
+        except Exception as e:
+            # keep serving the last good page rather than failing requests
+            print(' [!] Could not rebuild the page: ' + str(e))
+            sys.stdout.flush()
+            if _served['page'] is None:
+                raise
+        _served['checked'] = time.time()
+        return _served['page']
+
+# whether an Accept-Encoding header allows gzip
+def accepts_gzip(accept_encoding):
+
+    for part in accept_encoding.split(','):
+        params = [param.strip() for param in part.split(';')]
+        if params[0].lower() in ('gzip', '*'):
+            return not any(param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000') for param in params[1:])
+    return False
+
+# whether a conditional request's validators still match the page
+def is_not_modified(headers, etag, modified):
+
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since:
+        since = parsedate_tz(if_modified_since)
+        return since is not None and mktime_tz(since) >= modified
+
+    return False
+
+# answers GET and HEAD for the report out of memory
+class ReportHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_page(True)
+
+    def do_HEAD(self):
+        self.send_page(False)
+
+    def send_page(self, send_body):
+
+        if self.path.split('?', 1)[0] not in ('/', '/index.html', '/status.html'):
+            self.send_error(404)
+            return
+
+        try:
+            page = get_served_page(self.server.args, self.server.interval)
+        except Exception:
+            self.send_error(503)
+            return
+
+        if accepts_gzip(self.headers.get('Accept-Encoding', '')):
+            body, etag = page['gzip'], page['gzip_etag']
+        else:
+            body, etag = page['body'], page['etag']
+
+        status = 304 if is_not_modified(self.headers, etag, page['modified']) else 200
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(page['modified'], usegmt=True))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if status == 200:
+            self.send_header('Content-Type', 'text/html; charset=UTF-8')
+            self.send_header('Content-Length', str(len(body)))
+            if body is page['gzip']:
+                self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+
+        if status == 200 and send_body:
+            self.wfile.write(body)
+
+    # requests are not logged
+    def log_message(self, format, *args):
+        pass
+
+# handles each request on its own thread
+class ReportServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+# serve the report over HTTP at [ADDR:]PORT, building it on the first
+# request and again whenever the psad inputs change
+def serve(address, args):
+
+    host, separator, port = address.rpartition(':')
+    server = ReportServer((host.strip('[]'), int(port)), ReportHandler)
+    server.args = args
+    server.interval = args.watch if args.watch is not None else SERVE_INTERVAL
+
+    # build up front so the first visitor does not wait for it
+    get_served_page(args, server.interval)
+
+    print(' [*] Serving the report on http://' + (host or '0.0.0.0') + ':' + port + '/ (Ctrl-C to stop)')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+# read the JSON record a run keeps in its lock file
+def read_lock(fd):
+
+    try:
+        os.lseek(fd, 0, os.SEEK_SET)
+        return json.loads(os.read(fd, 4096).decode('utf-8'))
+    except (OSError, ValueError):
+        return {}
+
+# replace the lock file's record in place; renaming a new file over it
+# would hand waiters a different inode to lock
+def write_lock(fd, record):
+
+    os.ftruncate(fd, 0)
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.write(fd, json.dumps(record).encode('utf-8'))
+
+# the lock file shared by the runs that write the same outputs from the
+# same log directories the same way, so that a run never skips its own
+# outputs for another job's
+def get_lock_name(output_file, args):
+
+    key = [[name, os.path.abspath(log_dir)] for name, log_dir in args.sensors]
+    key += [path and os.path.abspath(path) for path in (output_file, args.data_dir, args.pages, args.conf, args.geoip, args.history)]
+    key += [args.exclude, args.allow, args.attackers, args.virtual, args.heatmap, args.data_format, args.compress]
+    digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+    return 'lock-' + digest[:12] + '.json'
+
+# run once, letting only one run at a time produce the same outputs from
+# the same log directories; the lock file in the cache directory is flock()ed, so the
+# kernel releases a run's lock when it exits or dies and a stale file
+# never blocks anyone. Later runs exit, or wait and reuse the result of
+# the run they waited for
+def run_single_flight(output_file, names, args):
+
+    if not args.lock or fcntl is None or not CACHE_DIR:
+        regenerate(output_file, {}, names, args)
+        return
+
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    lock_file = os.path.join(CACHE_DIR, get_lock_name(output_file, args))
+    started = time.time()
+
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            holder = read_lock(fd)
+            holder_msg = 'pid ' + str(holder.get('pid', '?'))
+            if 'started' in holder:
+                holder_msg += ', running for %.0fs' % (started - holder['started'])
+            if args.lock == 'exit':
+                print(' [*] Another run (' + holder_msg + ') is in progress, exiting')
+                return
+            print(' [*] Waiting for the run in progress (' + holder_msg + ')')
+            sys.stdout.flush()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            # only a run that finished after we started has newer output than
+            # we had; one that died leaves an older finish time behind
+            if read_lock(fd).get('finished', 0) >= started:
+                print(' [*] Reusing the output of the run that just finished')
+                return
+
+        record = {'pid': os.getpid(), 'started': time.time()}
+        write_lock(fd, record)
+        regenerate(output_file, {}, names, args)
+        record['finished'] = time.time()
+        write_lock(fd, record)
+    finally:
+        os.close(fd)
+
 def main():
 
+    global CACHE_DIR
+
     logo_msg = '\n PSADify v' + __version__
 
     epilog_msg = ('example:\n' +
@@ -540,6 +3360,27 @@ def main():
     parser = argparse.ArgumentParser(add_help=False,formatter_class=argparse.RawTextHelpFormatter,epilog=epilog_msg)
     parser.add_argument('-h', '--help', dest='show_help', action='store_true', help='Show this message and exit\n\n')
     parser.add_argument('-o', '--output', help='The file that is generated with the HTML content\n', type=str)
+    parser.add_argument('-l', '--log-dir', help='A PSAD log directory, as PATH or NAME=PATH; repeat it to\nmerge several sensors into one report (default: ' + PSAD_LOG_DIR + ')\n', type=str, action='append', dest='log_dirs')
+    parser.add_argument('--conf', help='The PSAD config file (default: ' + PSAD_CONF_FILE + ')\n', type=str, default=PSAD_CONF_FILE)
+    parser.add_argument('-x', '--exclude', help='File of networks (CIDR, one per line) to leave out on top\nof the private ranges; may be repeated\n', type=str, action='append', default=[], metavar='FILE')
+    parser.add_argument('-a', '--allow', help='File of networks to report even when they fall in an\nexcluded range; may be repeated\n', type=str, action='append', default=[], metavar='FILE')
+    parser.add_argument('-g', '--geoip', help='IP range database (CSV, or .mmdb with the maxminddb module)\nfor country and provider, with WHOIS files as a fallback\n', type=str, metavar='FILE')
+    parser.add_argument('-n', '--attackers', help='Number of top attackers to look up and show, 0 for all\n(default: ' + str(TOP_ATTACKERS) + ', or all with --virtual)\n', type=int)
+    parser.add_argument('--virtual', help='Embed the attackers and ports as compact rows and show all of\nthem in scrolling, sortable tables drawn by the browser\n', action='store_true')
+    parser.add_argument('--heatmap', help='Add a Port Heatmap tab counting the attackers behind every\nTCP and UDP port in the alert files\n', action='store_true')
+    parser.add_argument('-p', '--pages', help='Directory for a detail page per attacker, linked from the\ntables; only pages whose alert or WHOIS files changed\nare written\n', type=str, metavar='DIR')
+    parser.add_argument('-d', '--data-dir', help='Write each section as a data file plus a static index.html\nthat loads them; skips OUTPUT unless -o is also given\n', type=str, metavar='DIR')
+    parser.add_argument('--data-format', help='Format of the data files: json or ndjson (default: json)\n', choices=('json', 'ndjson'), default='json')
+    parser.add_argument('-z', '--compress', help='Also write .gz (and .br if brotli is installed) copies of\nthe output for web servers that serve precompressed files\n', action='store_true')
+    parser.add_argument('-j', '--jobs', help='Run the collectors concurrently and read files with JOBS\nthreads (default: 1)\n', type=int, default=1)
+    parser.add_argument('-m', '--metrics', help='Directory to write per-stage metrics to, as psadify.json\nand psadify.prom (Prometheus textfile collector)\n', type=str, metavar='DIR')
+    parser.add_argument('-w', '--watch', help='Keep running and regenerate when PSAD data changes,\npolling every SECONDS\n', type=float, nargs='?', const=5.0, metavar='SECONDS')
+    parser.add_argument('-s', '--serve', help='Serve the report over HTTP from memory at [ADDR:]PORT,\nrebuilding it when PSAD data changes (checked at most\nevery -w SECONDS, default: ' + str(int(SERVE_INTERVAL)) + ')\n', type=str, metavar='[ADDR:]PORT')
+    parser.add_argument('--settle', help='Seconds of quiet to wait for before regenerating in\nwatch mode (default: 2)\n', type=float, default=2.0)
+    parser.add_argument('--history', help='Keep each run\'s hits in an SQLite database and add a Trends\ntab with the top movers of the last 24h (default FILE:\nhistory.sqlite in the cache directory)\n', type=str, nargs='?', const='', metavar='FILE')
+    parser.add_argument('--retention', help='Days of history to keep (default: ' + str(HISTORY_RETENTION) + ')\n', type=int, default=HISTORY_RETENTION, metavar='DAYS')
+    parser.add_argument('--lock', help='Allow one run at a time per set of log directories and\noutputs: exit right away, or wait and reuse the result of\nthe run in progress\n', choices=('exit', 'wait'))
+    parser.add_argument('-c', '--cache-dir', help='Directory for state kept between runs (default: ' + CACHE_DIR + ')\n', type=str)
     parser.set_defaults(show_help='False')
     args = parser.parse_args()
 
@@ -550,15 +3391,61 @@ def main():
 
     print(logo_msg)
 
+    # the data files replace the full page unless both are asked for
     output_file = 'status.html'
     if args.output:
         output_file = args.output
-
-    html = get_html(get_last_attacks(), get_top_attackers(), get_top_signatures(), get_top_ports())
-
-    with open(output_file, 'w') as f:
-        print(' [*] Writing output to ' + output_file)
-        f.write(html)
+    elif args.data_dir:
+        output_file = None
+
+    if args.cache_dir is not None:
+        CACHE_DIR = args.cache_dir
+
+    args.sensors = [parse_sensor(log_dir) for log_dir in args.log_dirs or [PSAD_LOG_DIR]]
+
+    # a limit of None looks up every attacker
+    if args.attackers is None:
+        args.attackers = 0 if args.virtual else TOP_ATTACKERS
+    args.attackers = args.attackers or None
+
+    try:
+        set_ip_filter(args.exclude, args.allow)
+    except (IOError, OSError, ValueError) as e:
+        print(' [!] Could not load the network lists: ' + str(e))
+        sys.exit(1)
+
+    if args.geoip:
+        try:
+            load_geoip(args.geoip)
+        except (IOError, OSError, ValueError) as e:
+            print(' [!] Could not load the GeoIP database: ' + str(e))
+            sys.exit(1)
+
+    if args.history is not None:
+        try:
+            open_history(args.history or os.path.join(CACHE_DIR, 'history.sqlite'), args.retention)
+        except (OSError, ValueError) as e:
+            print(' [!] Could not open the history database: ' + str(e))
+            sys.exit(1)
+
+    set_jobs(args.jobs)
+
+    if args.serve:
+        try:
+            serve(args.serve, args)
+        except KeyboardInterrupt:
+            pass
+        except (socket.error, ValueError) as e:
+            print(' [!] Could not serve the report: ' + str(e))
+            sys.exit(1)
+    elif args.watch is not None:
+        print(' [*] Watching PSAD data every ' + str(args.watch) + 's (Ctrl-C to stop)')
+        try:
+            watch(output_file, args)
+        except KeyboardInterrupt:
+            pass
+    else:
+        run_single_flight(output_file, [name for name, input in COLLECTORS], args)
 
     print('')
 